@@ -0,0 +1,86 @@
+"""Async versions of the resources.REGISTRY routes, mounted by main when DB_MODE=async.
+
+The routes are generated from the same Resource entries as the sync
+ones, with the same ops, filters, readonly fields and defaults. Lists
+run Resource.page, refcache and the after_list hooks on the request's
+AsyncSession through run_sync, so both modes share the cached
+statements and the response shapes. Lists read the async primary,
+replicas are only used in sync mode.
+
+The router is included before resources.router, so its paths take
+precedence over the sync routes with the same path.
+"""
+from typing import List, Union
+
+from fastapi import APIRouter, Depends, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import deps
+import models as md
+import refcache
+import serializer
+from db_async import add_async, get_async_db, get_one_async, update_async
+from resources import ADD, GET, LIST, REGISTRY, UPDATE, Resource
+
+
+def add_async_routes(resource: Resource, router: APIRouter):
+  sql_model = resource.sql_model
+  table = sql_model.__tablename__
+
+  async def get_item(item_id: int, user: deps.CachedUser = Depends(deps.auth_middleware_async),
+                     db: AsyncSession = Depends(get_async_db)):
+    return await get_one_async(item_id, sql_model, db)
+
+  async def get_all(request: Request, page: int, page_size: int, cursor: Union[str, None],
+                    with_count: bool, user: deps.CachedUser, db: AsyncSession, name: str = '',
+                    **values):
+    if resource.cached:
+      cached = await db.run_sync(lambda sync_db: refcache.lookup(request, sql_model, sync_db))
+      if cached is not None:
+        return cached
+    data = await db.run_sync(lambda sync_db: resource.page(
+        sync_db, values, page, page_size, cursor, with_count, name))
+    if resource.cached:
+      return refcache.store(request, sql_model, data)
+    return serializer.json_response(data)
+
+  # FastAPI reads the query parameters from the signature
+  get_all.__signature__ = resource.list_signature(
+      auth=deps.auth_middleware_async, read_db=get_async_db, session_type=AsyncSession)
+
+  if GET in resource.ops:
+    router.add_api_route(f'{resource.path}/{{item_id}}', get_item, methods=['GET'],
+                         name=f'get_{table}')
+  if LIST in resource.ops:
+    router.add_api_route(resource.path, get_all, methods=['GET'], name=f'list_{table}')
+  if ADD not in resource.ops and UPDATE not in resource.ops:
+    return
+  pydantic_model = getattr(md, resource.pydantic)
+
+  async def add_item(item: pydantic_model, user: deps.CachedUser = Depends(deps.auth_middleware_async),
+                     db: AsyncSession = Depends(get_async_db)):
+    for k, v in resource.defaults.items():
+      setattr(item, k, v)
+    return await add_async(item, sql_model(), db, user.id)
+
+  async def update_item(item: pydantic_model, item_id: int,
+                        user: deps.CachedUser = Depends(deps.auth_middleware_async),
+                        db: AsyncSession = Depends(get_async_db)):
+    return await update_async(item=item, item_id=item_id, sql_model=sql_model, db=db,
+                              readonly=resource.readonly)
+
+  if ADD in resource.ops:
+    router.add_api_route(resource.path, add_item, methods=['POST'], name=f'add_{table}')
+  if UPDATE in resource.ops:
+    router.add_api_route(f'{resource.path}/{{item_id}}', update_item, methods=['PUT'],
+                         name=f'update_{table}')
+
+
+def async_router(resources: List[Resource]) -> APIRouter:
+  router = APIRouter()
+  for resource in resources:
+    add_async_routes(resource, router)
+  return router
+
+
+router = async_router(REGISTRY)
@@ -1,5 +1,9 @@
 from passlib.context import CryptContext
 import os
+import time
+import asyncio
+from threading import BoundedSemaphore, Lock
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Union, Any
 from jose import jwt
@@ -25,6 +29,91 @@ def verify_password(password: str, hashed_pass: str) -> bool:
   return password_context.verify(password, hashed_pass)
 
 
+class PasswordPoolBusy(Exception):
+  pass
+
+
+class PasswordPool:
+  """Dedicated executor for bcrypt work with a bounded number of waiting jobs."""
+
+  def __init__(self, workers: int, max_queue: int):
+    self.workers = workers
+    self.max_queue = max_queue
+    self._executor = ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix='bcrypt')
+    self._slots = BoundedSemaphore(workers + max_queue)
+    self._lock = Lock()
+    self.pending = 0
+    self.completed = 0
+    self.rejected = 0
+    self.wait_total = 0.0
+    self.wait_max = 0.0
+    self.hash_total = 0.0
+    self.hash_max = 0.0
+
+  def _run(self, queued_at: float, fn, args):
+    started = time.perf_counter()
+    try:
+      return fn(*args)
+    finally:
+      finished = time.perf_counter()
+      self._slots.release()
+      with self._lock:
+        self.pending -= 1
+        self.completed += 1
+        self.wait_total += started - queued_at
+        self.wait_max = max(self.wait_max, started - queued_at)
+        self.hash_total += finished - started
+        self.hash_max = max(self.hash_max, finished - started)
+
+  def submit(self, fn, *args):
+    if not self._slots.acquire(blocking=False):
+      with self._lock:
+        self.rejected += 1
+      raise PasswordPoolBusy()
+    with self._lock:
+      self.pending += 1
+    try:
+      return self._executor.submit(self._run, time.perf_counter(), fn, args)
+    except Exception:
+      self._slots.release()
+      with self._lock:
+        self.pending -= 1
+      raise
+
+  async def run(self, fn, *args):
+    return await asyncio.wrap_future(self.submit(fn, *args))
+
+  def stats(self) -> dict:
+    done = self.completed or 1
+    return {
+        'workers': self.workers,
+        'max_queue': self.max_queue,
+        'pending': self.pending,
+        'completed': self.completed,
+        'rejected': self.rejected,
+        'queue_wait_avg_ms': self.wait_total / done * 1000,
+        'queue_wait_max_ms': self.wait_max * 1000,
+        'hash_time_avg_ms': self.hash_total / done * 1000,
+        'hash_time_max_ms': self.hash_max * 1000,
+    }
+
+
+password_pool = PasswordPool(
+    workers=int(os.environ.get('PASSWORD_POOL_WORKERS', 2)),
+    max_queue=int(os.environ.get('PASSWORD_POOL_QUEUE', 32)),
+)
+
+
+async def get_hashed_password_async(password: str) -> str:
+  return await password_pool.run(get_hashed_password, password)
+
+
+async def verify_and_update_password_async(password: str, hashed_pass: str) -> tuple:
+  """Returns (is_valid, new_hash), new_hash is set when the stored hash is deprecated."""
+  return await password_pool.run(password_context.verify_and_update, password, hashed_pass)
+
+
 def create_access_token(user_id: int, expires_delta: int = None) -> str:
   if expires_delta is not None:
     expires_delta = datetime.utcnow() + expires_delta
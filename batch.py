@@ -0,0 +1,113 @@
+"""Multi-get endpoints backed by a request-scoped loader.
+
+GET /api/{entity}/batch?ids=1,2,3 returns many rows of one entity and
+GET /api/batch?product=1,2&unit=5 several entities at once. Ids are
+collected per model by a Loader shared by everything that runs in the
+request (FastAPI caches the get_loader dependency per request), rows
+already in the Session identity map are reused and the rest are read
+with one IN query per model.
+"""
+from typing import Dict, List, Union
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.exceptions import HTTPException
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+
+import deps
+import models as md
+from db_conn import get_db
+
+router = APIRouter()
+
+MAX_IDS = 1000
+
+ENTITIES = {
+    'product': md.Product,
+    'supplier': md.Supplier,
+    'unit': md.Unit,
+    'master': md.Master,
+    'stock': md.Stock,
+}
+
+
+class Loader:
+  def __init__(self, db: Session):
+    self.db = db
+    self._pending: Dict[type, set] = {}
+    # strong references, the identity map only holds weak ones
+    self._loaded: Dict[type, dict] = {}
+
+  def prime(self, sql_model, ids):
+    """Queue ids to be read with the next load of `sql_model`."""
+    self._pending.setdefault(sql_model, set()).update(ids)
+
+  def _dispatch(self, sql_model):
+    loaded = self._loaded.setdefault(sql_model, {})
+    ids = self._pending.pop(sql_model, set()) - loaded.keys()
+    missing = []
+    for item_id in ids:
+      obj = self.db.identity_map.get(identity_key(sql_model, item_id))
+      if obj is None:
+        missing.append(item_id)
+      else:
+        loaded[item_id] = obj
+    if missing:
+      for obj in self.db.query(sql_model).filter(sql_model.id.in_(missing)):
+        loaded[obj.id] = obj
+
+  def load_many(self, sql_model, ids: List[int]) -> list:
+    """Rows for `ids` in the same order, None where there is no row."""
+    self.prime(sql_model, ids)
+    self._dispatch(sql_model)
+    loaded = self._loaded[sql_model]
+    return [loaded.get(x) for x in ids]
+
+  def load(self, sql_model, item_id: int):
+    return self.load_many(sql_model, [item_id])[0]
+
+
+def get_loader(db: Session = Depends(get_db)) -> Loader:
+  return Loader(db)
+
+
+def parse_ids(value: str) -> List[int]:
+  try:
+    ids = [int(x) for x in value.split(',') if x.strip()]
+  except ValueError:
+    raise HTTPException(status_code=400, detail="ids must be a comma separated list of integers")
+  if len(ids) > MAX_IDS:
+    raise HTTPException(status_code=400, detail=f"at most {MAX_IDS} ids per request")
+  return list(dict.fromkeys(ids))
+
+
+def batch_result(loader: Loader, sql_model, ids: List[int]) -> dict:
+  rows = loader.load_many(sql_model, ids)
+  return {
+      'items': [x for x in rows if x is not None],
+      'missing': [i for i, x in zip(ids, rows) if x is None],
+  }
+
+
+@router.get("/api/batch")
+def get_batch(request: Request, user: md.User = Depends(deps.auth_middleware),
+              loader: Loader = Depends(get_loader)):
+  """Several entities at once: /api/batch?product=1,2&supplier=3."""
+  unknown = set(request.query_params) - ENTITIES.keys()
+  if unknown:
+    raise HTTPException(status_code=400, detail=f"unknown entities: {', '.join(sorted(unknown))}")
+  wanted = {name: parse_ids(request.query_params[name]) for name in request.query_params}
+  if sum(map(len, wanted.values())) > MAX_IDS:
+    raise HTTPException(status_code=400, detail=f"at most {MAX_IDS} ids per request")
+  for name, ids in wanted.items():
+    loader.prime(ENTITIES[name], ids)
+  return {name: batch_result(loader, ENTITIES[name], ids) for name, ids in wanted.items()}
+
+
+@router.get("/api/{entity}/batch")
+def get_entity_batch(entity: str, ids: Union[str, None] = None,
+                     user: md.User = Depends(deps.auth_middleware),
+                     loader: Loader = Depends(get_loader)):
+  if entity not in ENTITIES:
+    raise HTTPException(status_code=404, detail=f"unknown entity {entity}")
+  return batch_result(loader, ENTITIES[entity], parse_ids(ids or ''))
@@ -0,0 +1,72 @@
+"""Invoice-size scaling of arrival ingestion, per-line commits vs one bulk transaction.
+
+Writes into the database configured in db_conn, point it at a scratch
+database. Run from the repository root: python -m bench.arrival [sizes...]
+"""
+import sys
+import time
+from datetime import date
+
+import models as md
+from db_conn import SessionLocal
+from deps import CachedUser
+import main
+
+
+def legacy_add_arrival(item: md.PydanticArrivalAdd, user_id: int, db):
+  # the former add_arrival: one SELECT and one commit per invoice line
+  for x in item.items:
+    ar = md.Arrival(manufacturer=x.manufacturer, product_id=x.product_id,
+                    count=x.count, unit_id=x.unit_id,
+                    purchase_price=x.purchase_price,
+                    retail_price=x.retail_price, info=x.info,
+                    invoce_number=item.invoce_number,
+                    supplier_id=item.supplier_id, user_id=user_id)
+    db.add(ar)
+    st = db.query(md.Stock).filter(
+        md.Stock.product_id == ar.product_id,
+        md.Stock.supplier_id == ar.supplier_id,
+        md.Stock.price == ar.retail_price).first()
+    if st is None:
+      st = md.Stock(product_id=ar.product_id, supplier_id=ar.supplier_id,
+                    count=0, price=ar.retail_price, unit_id=ar.unit_id)
+    st.count += ar.count
+    db.add(st)
+    db.commit()
+
+
+def make_invoice(size: int, supplier_id: int, unit_id: int, product_ids: list):
+  return md.PydanticArrivalAdd(
+      supplier_id=supplier_id, invoce_number=f'bench-{size}',
+      date=date.today(),
+      items=[md.PydanticArrivalList(
+          manufacturer='bench', product_id=product_ids[i % len(product_ids)],
+          count=1, unit_id=unit_id, purchase_price=1,
+          retail_price=2 + i % 7, info='') for i in range(size)])
+
+
+def main_bench(sizes):
+  db = SessionLocal()
+  user = db.query(md.User.id).first()
+  supplier = md.Supplier(name='bench', user_id=user.id)
+  unit = md.Unit(name='bench', user_id=user.id)
+  products = [md.Product(name=f'bench {i}', user_id=user.id) for i in range(50)]
+  db.add_all([supplier, unit, *products])
+  db.commit()
+  product_ids = [p.id for p in products]
+  cached_user = CachedUser(user.id, '', False)
+  print(f'{"lines":>6} {"legacy ms":>10} {"bulk ms":>10}')
+  for size in sizes:
+    invoice = make_invoice(size, supplier.id, unit.id, product_ids)
+    started = time.perf_counter()
+    legacy_add_arrival(invoice, user.id, db)
+    legacy = time.perf_counter() - started
+    started = time.perf_counter()
+    main.add_arrival(invoice, cached_user, db)
+    bulk = time.perf_counter() - started
+    print(f'{size:>6} {legacy * 1000:>10.1f} {bulk * 1000:>10.1f}')
+  db.close()
+
+
+if __name__ == '__main__':
+  main_bench([int(x) for x in sys.argv[1:]] or [10, 50, 200, 1000])
@@ -0,0 +1,29 @@
+"""Per-request cost of token verification with and without the token cache.
+
+Run from the repository root: python -m bench.auth [iterations]
+"""
+import sys
+import timeit
+
+import auth
+import deps
+
+
+def main(iterations: int = 20000):
+  token = auth.create_access_token(1)
+
+  def uncached():
+    deps.token_cache.clear()
+    deps.verify_token(token, auth.JWT_SECRET_KEY, "access")
+
+  def cached():
+    deps.verify_token(token, auth.JWT_SECRET_KEY, "access")
+
+  cached()
+  for name, fn in (('uncached', uncached), ('cached', cached)):
+    seconds = min(timeit.repeat(fn, number=iterations, repeat=3))
+    print(f'{name:>9}: {seconds / iterations * 1e6:8.2f} us/request')
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,74 @@
+"""FIFO cost engine over several years of movements.
+
+Without --db only the in-memory Ledger replay is timed on synthetic
+movements. With --db the database configured in db_conn is used (seed
+it with bench.seed): a full rebuild is timed, then `--new` sales are
+added and the update, which replays the history of their products, is
+timed. Run from the repository root:
+  python -m bench.cogs [--years N] [--products N] [--db] [--new N]
+"""
+import argparse
+import random
+import time
+from datetime import date
+
+import cogs
+import fifo
+import models as md
+
+
+def ledger_replay(args):
+  rnd = random.Random(args.seed)
+  days = args.years * 365
+  per_day = args.movements // days
+  ledger = fifo.Ledger()
+  started = time.perf_counter()
+  for _ in range(days):
+    for _ in range(per_day):
+      product_id = rnd.randrange(args.products)
+      if rnd.random() < 0.3:
+        ledger.add(product_id, rnd.randrange(1, 50), rnd.uniform(50, 3000))
+      else:
+        ledger.take(product_id, rnd.randrange(1, 4))
+  elapsed = time.perf_counter() - started
+  print(f'ledger: {per_day * days} movements over {args.years} years in {elapsed:.2f} s '
+        f'({per_day * days / elapsed:,.0f}/s)')
+
+
+def database(args):
+  from db_conn import SessionLocal
+  db = SessionLocal()
+  started = time.perf_counter()
+  result = cogs.rebuild(db)
+  print(f'rebuild: {result} in {time.perf_counter() - started:.2f} s')
+
+  rnd = random.Random(args.seed)
+  user = db.query(md.User.id).first()
+  stock = db.query(md.Stock.id, md.Stock.price).limit(10_000).all()
+  for i in range(args.new):
+    sale = md.Sale(date=date.today(), car_model='bench', car_vin=f'COGS{i}',
+                   price=0, user_id=user.id)
+    db.add(sale)
+    db.flush()
+    lines = {x.id: x.price for x in rnd.sample(stock, rnd.randrange(1, 4))}
+    db.execute(md.sale_product_relationship.insert(), [
+        {'sale_id': sale.id, 'stock_id': k, 'count': 1, 'price': v} for k, v in lines.items()])
+  db.commit()
+  started = time.perf_counter()
+  result = cogs.update(db)
+  print(f'update: {result} in {time.perf_counter() - started:.2f} s')
+  db.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--years', type=int, default=5)
+  parser.add_argument('--products', type=int, default=20_000)
+  parser.add_argument('--movements', type=int, default=2_000_000)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--db', action='store_true')
+  parser.add_argument('--new', type=int, default=1000)
+  args = parser.parse_args()
+  ledger_replay(args)
+  if args.db:
+    database(args)
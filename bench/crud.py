@@ -0,0 +1,72 @@
+"""Per-request list statement construction, ad-hoc filters vs resources' cached statements.
+
+The ad-hoc path rebuilds the query with filters.* for every request, as
+the list handlers in main used to; the resource path binds the values
+to the statement cached for the filter signature. Both pay for the
+cache key the engine computes on execute; compiling is served by the
+compiled cache in both cases and is left out. No database needed.
+Run from the repository root: python -m bench.crud [requests]
+"""
+import statistics
+import sys
+import time
+from datetime import date
+
+import filters
+import models as md
+import resources
+
+REQUESTS = [
+    ('arrival', {'supplier_id': 3, 'from_date': date(2023, 1, 1), 'to_date': date(2023, 6, 30)}),
+    ('arrival', {'product_id': 17, 'invoce_number': 'INV-12'}),
+    ('arrival', {'supplier_id': 9, 'from_date': date(2023, 2, 1), 'to_date': date(2023, 3, 1)}),
+    ('sale', {'master_id': 2, 'car_vin': 'XTA'}),
+    ('sale', {'product_id': 5, 'from_price': 100.0, 'to_price': 900.0}),
+    ('sale', {'master_id': 4, 'car_vin': 'WVW'}),
+]
+
+registry = {r.path: r for r in resources.REGISTRY}
+RESOURCES = {
+    'arrival': (registry['/api/arrival'], resources.arrival_rows, filters.arrival, md.Arrival),
+    'sale': (registry['/api/sale'], resources.sale_rows, filters.sale, md.Sale),
+}
+
+
+def ad_hoc(name: str, values: dict, page: int = 2, page_size: int = 10):
+  _, rows, apply, sql_model = RESOURCES[name]
+  stmt = apply(rows.select().order_by(sql_model.id.desc()), **values)
+  stmt = stmt.limit(page_size).offset((page - 1) * page_size)
+  return stmt._generate_cache_key()
+
+
+def cached(name: str, values: dict, page: int = 2, page_size: int = 10):
+  resource = RESOURCES[name][0]
+  params = {k: resource.filters[k].param(v) for k, v in values.items()
+            if resource.filters[k].active(v)}
+  _, stmt = resource.statements(tuple(sorted(params)), False, resources.OFFSET)
+  params.update(limit=page_size, offset=(page - 1) * page_size)
+  return stmt._generate_cache_key()
+
+
+def measure(build, n: int) -> list:
+  timings = []
+  for i in range(n):
+    name, values = REQUESTS[i % len(REQUESTS)]
+    started = time.perf_counter()
+    build(name, values)
+    timings.append((time.perf_counter() - started) * 1_000_000)
+  return sorted(timings)
+
+
+def report(name: str, timings: list):
+  p95 = timings[int(len(timings) * 0.95) - 1]
+  print(f'{name:>8}: p50 {statistics.median(timings):8.1f} us  p95 {p95:8.1f} us')
+
+
+def main(n: int = 20_000):
+  report('ad-hoc', measure(ad_hoc, n))
+  report('cached', measure(cached, n))
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,162 @@
+"""Per-endpoint load benchmark against a running server and a seeded database.
+
+Every route is taken from the server's OpenAPI schema. Path and query
+parameters are filled from PARAMS, request bodies from BODIES; routes
+without a usable body are listed as skipped. Results are written as
+JSON so two runs can be compared:
+
+  python -m bench.seed --truncate
+  python -m bench.endpoints --login user1 --password password --out before.json
+  python -m bench.endpoints --login user1 --password password --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from datetime import date
+
+import httpx
+
+PARAMS = {
+    'item_id': lambda r: r.randrange(1, 1000),
+    'page': lambda r: r.randrange(1, 50),
+    'page_size': lambda r: 10,
+    'name': lambda r: r.choice(['', 'filter', 'pro', 'bulb 1']),
+    'from_date': lambda r: '2020-01-01',
+    'to_date': lambda r: '2020-12-31',
+    'group_by': lambda r: r.choice(['master', 'user', 'product']),
+    'format': lambda r: 'ndjson',
+}
+
+BODIES = {
+    ('POST', '/api/login'): lambda r, a: {'login': a.login, 'password': a.password},
+    ('POST', '/api/product'): lambda r, a: {'name': f'bench product {r.random()}'},
+    ('PUT', '/api/product/{item_id}'): lambda r, a: {'name': f'bench product {r.random()}'},
+    ('POST', '/api/supplier'): lambda r, a: {'name': f'bench supplier {r.random()}'},
+    ('PUT', '/api/supplier/{item_id}'): lambda r, a: {'name': f'bench supplier {r.random()}'},
+    ('POST', '/api/unit'): lambda r, a: {'name': f'bench unit {r.random()}'},
+    ('PUT', '/api/unit/{item_id}'): lambda r, a: {'name': f'bench unit {r.random()}'},
+    ('POST', '/api/master'): lambda r, a: {'name': 'bench master', 'amount': 0, 'percentage': 5},
+    ('PUT', '/api/master/{item_id}'): lambda r, a: {'name': 'bench master', 'percentage': 5},
+    ('POST', '/api/arrival'): lambda r, a: {
+        'supplier_id': r.randrange(1, 200), 'invoce_number': 'bench',
+        'date': str(date.today()),
+        'items': [{'manufacturer': 'bench', 'product_id': r.randrange(1, 1000),
+                   'count': 5, 'unit_id': 1, 'purchase_price': 10,
+                   'retail_price': 15, 'info': ''} for _ in range(20)]},
+    ('PUT', '/api/sale/{item_id}'): lambda r, a: {'service': 'bench'},
+    ('POST', '/api/product_return'): lambda r, a: {
+        'supplier_id': 1, 'product_id': 1, 'count': 1, 'invoce_number': 'bench', 'price': 1},
+    ('POST', '/api/disposal'): lambda r, a: {'product_id': 1, 'count': 0, 'cause': 'bench'},
+    ('PUT', '/api/disposal/{item_id}'): lambda r, a: {'cause': 'bench'},
+    ('POST', '/api/inventory'): lambda r, a: {'inventory_cause': 'bench', 'info': ''},
+    ('PUT', '/api/inventory/{item_id}'): lambda r, a: {'info': 'bench'},
+}
+
+# writes that can not be repeated blindly against the same rows
+SKIP = {
+    ('POST', '/api/user'), ('POST', '/api/login_form'), ('GET', '/api/refresh_token'),
+    ('DELETE', '/api/product_return/{item_id}'), ('POST', '/api/product_return/spend'),
+    ('POST', '/api/sale'), ('PUT', '/api/arrival/{item_id}'),
+    ('PUT', '/api/product_return/{item_id}'),
+}
+
+
+def routes(schema: dict):
+  for path, methods in schema['paths'].items():
+    for method, op in methods.items():
+      params = [p['name'] for p in op.get('parameters', [])
+                if p['in'] in ('path', 'query') and (p.get('required') or p['name'] in PARAMS)]
+      yield method.upper(), path, params, 'requestBody' in op
+
+
+def build(rnd, args, method, path, params):
+  values = {name: PARAMS[name](rnd) if name in PARAMS else 1 for name in params}
+  url = path.format(**values)
+  query = {k: v for k, v in values.items() if '{' + k + '}' not in path}
+  body = BODIES.get((method, path))
+  return url, query, body(rnd, args) if body else None
+
+
+async def bench_route(client, headers, args, method, path, params):
+  rnd = random.Random(args.seed)
+  timings, statuses = [], {}
+  sem = asyncio.Semaphore(args.concurrency)
+
+  async def one():
+    url, query, body = build(rnd, args, method, path, params)
+    async with sem:
+      started = time.perf_counter()
+      r = await client.request(method, url, params=query, json=body, headers=headers)
+      timings.append(time.perf_counter() - started)
+    statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+  started = time.perf_counter()
+  await asyncio.gather(*[one() for _ in range(args.requests)])
+  elapsed = time.perf_counter() - started
+  timings.sort()
+  pick = lambda q: timings[max(0, int(len(timings) * q) - 1)] * 1000
+  return {
+      'p50_ms': statistics.median(timings) * 1000,
+      'p95_ms': pick(0.95),
+      'p99_ms': pick(0.99),
+      'rps': len(timings) / elapsed,
+      'statuses': {str(k): v for k, v in sorted(statuses.items())},
+  }
+
+
+async def run(args) -> dict:
+  async with httpx.AsyncClient(base_url=args.url, timeout=120) as client:
+    schema = (await client.get('/openapi.json')).json()
+    r = await client.post('/api/login', json={'login': args.login, 'password': args.password})
+    r.raise_for_status()
+    headers = {'Authorization': f'Bearer {r.json()["access_token"]}'}
+    results, skipped = {}, []
+    for method, path, params, has_body in routes(schema):
+      key = f'{method} {path}'
+      if args.only and args.only not in path:
+        continue
+      if (method, path) in SKIP or (has_body and (method, path) not in BODIES):
+        skipped.append(key)
+        continue
+      results[key] = await bench_route(client, headers, args, method, path, params)
+      res = results[key]
+      print(f'{key:<45} p50 {res["p50_ms"]:8.1f}  p95 {res["p95_ms"]:8.1f}  '
+            f'p99 {res["p99_ms"]:8.1f} ms  {res["rps"]:8.1f} req/s  {res["statuses"]}')
+  if skipped:
+    print('skipped:', ', '.join(skipped))
+  return {'url': args.url, 'time': time.time(), 'requests': args.requests,
+          'concurrency': args.concurrency, 'results': results, 'skipped': skipped}
+
+
+def compare(old: dict, new: dict):
+  print(f'\n{"route":<45} {"p95 before":>11} {"p95 after":>10} {"change":>8}')
+  for key, res in new['results'].items():
+    before = old['results'].get(key)
+    if before is None:
+      continue
+    change = (res['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+    print(f'{key:<45} {before["p95_ms"]:>11.1f} {res["p95_ms"]:>10.1f} {change:>+7.1f}%')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--url', default='http://127.0.0.1:8000')
+  parser.add_argument('--login', required=True)
+  parser.add_argument('--password', required=True)
+  parser.add_argument('--requests', type=int, default=200)
+  parser.add_argument('--concurrency', type=int, default=20)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--only', help='only routes whose path contains this')
+  parser.add_argument('--out', help='write results as JSON')
+  parser.add_argument('--compare', help='JSON of an earlier run')
+  args = parser.parse_args()
+  report = asyncio.run(run(args))
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(report, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      compare(json.load(f), report)
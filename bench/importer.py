@@ -0,0 +1,50 @@
+"""Bulk CSV import vs one POST /api/product add per row.
+
+Writes into the database configured in db_conn, point it at a scratch
+database. The per-row path is timed on the first --legacy rows only.
+Run from the repository root: python -m bench.importer [rows] [--legacy N]
+"""
+import argparse
+import io
+import time
+
+from fastapi import UploadFile
+
+import importer
+import models as md
+import resources
+from db_conn import SessionLocal
+from deps import CachedUser
+
+
+def product_csv(rows: int) -> bytes:
+  lines = ['name'] + [f'import bench {i}' for i in range(rows)]
+  return ('\n'.join(lines) + '\n').encode()
+
+
+def main_bench(args):
+  db = SessionLocal()
+  user = db.query(md.User.id).first()
+  cached_user = CachedUser(user.id, '', False)
+
+  started = time.perf_counter()
+  for i in range(args.legacy):
+    resources.add(md.PydanticProduct(id=0, name=f'import legacy {i}'), md.Product(), db, cached_user.id)
+  legacy = time.perf_counter() - started
+  print(f'resources.add: {args.legacy} rows in {legacy:.2f} s, '
+        f'{legacy / args.legacy * args.rows:.0f} s extrapolated to {args.rows}')
+
+  upload = UploadFile(file=io.BytesIO(product_csv(args.rows)), filename='products.csv')
+  started = time.perf_counter()
+  report = importer.import_csv('product', upload, cached_user, db)
+  elapsed = time.perf_counter() - started
+  print(f'/api/import: {report["imported"]} rows in {elapsed:.2f} s, '
+        f'{report["failed"]} failed')
+  db.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('rows', type=int, nargs='?', default=100_000)
+  parser.add_argument('--legacy', type=int, default=1000)
+  main_bench(parser.parse_args())
@@ -0,0 +1,45 @@
+"""Inventory count of every stock row: batched line submit and close.
+
+Writes into the database configured in db_conn, point it at a scratch
+database seeded with bench.seed (50k stock rows by default).
+Run from the repository root: python -m bench.inventory [--batch N]
+"""
+import argparse
+import random
+import time
+
+import inventory
+import models as md
+from db_conn import SessionLocal
+
+
+def main_bench(args):
+  rnd = random.Random(args.seed)
+  db = SessionLocal()
+  user = db.query(md.User.id).first()
+  header = md.Inventory(inventory_cause='bench', info='', user_id=user.id, status=0)
+  db.add(header)
+  db.commit()
+  stock = db.query(md.Stock.id, md.Stock.count).all()
+
+  started = time.perf_counter()
+  for i in range(0, len(stock), args.batch):
+    counts = [md.PydanticInventoryCount(
+        stock_id=x.id, counted=max(0, x.count + rnd.choice([0, 0, 0, -1, 1])))
+        for x in stock[i:i + args.batch]]
+    inventory.submit(db, header.id, counts)
+  submitted = time.perf_counter() - started
+
+  started = time.perf_counter()
+  result = inventory.close(db, header.id)
+  closed = time.perf_counter() - started
+  print(f'{len(stock)} lines: submit {submitted:.2f} s in batches of {args.batch}, '
+        f'close {closed:.2f} s, {result["changed"]} adjusted')
+  db.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--batch', type=int, default=1000)
+  parser.add_argument('--seed', type=int, default=1)
+  main_bench(parser.parse_args())
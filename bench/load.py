@@ -0,0 +1,68 @@
+"""Concurrency load test for the list endpoints of a running server.
+
+Start the app once with DB_MODE=sync and once with DB_MODE=async (same
+DB_POOL_SIZE) and compare the numbers:
+
+  python -m bench.load --url http://127.0.0.1:8000 --login admin --password secret \
+      --concurrency 200 --requests 5000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+PATHS = [
+    '/api/product', '/api/supplier', '/api/unit', '/api/master',
+    '/api/arrival', '/api/sale', '/api/stock', '/api/product_return',
+    '/api/disposal', '/api/inventory',
+]
+
+
+async def login(client: httpx.AsyncClient, username: str, password: str) -> str:
+  r = await client.post('/api/login', json={'login': username, 'password': password})
+  r.raise_for_status()
+  return r.json()['access_token']
+
+
+async def run(args):
+  limits = httpx.Limits(max_connections=args.concurrency)
+  async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+    token = await login(client, args.login, args.password)
+    headers = {'Authorization': f'Bearer {token}'}
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+      queue.put_nowait(PATHS[i % len(PATHS)])
+    timings, errors = [], 0
+
+    async def worker():
+      nonlocal errors
+      while not queue.empty():
+        path = queue.get_nowait()
+        started = time.perf_counter()
+        r = await client.get(path, headers=headers)
+        timings.append(time.perf_counter() - started)
+        if r.status_code != 200:
+          errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - started
+
+  timings.sort()
+  print(f'requests {len(timings)}  errors {errors}  concurrency {args.concurrency}')
+  print(f'throughput {len(timings) / elapsed:.1f} req/s')
+  print(f'latency p50 {statistics.median(timings) * 1000:.1f} ms  '
+        f'p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.1f} ms  '
+        f'p99 {timings[int(len(timings) * 0.99) - 1] * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--url', default='http://127.0.0.1:8000')
+  parser.add_argument('--login', required=True)
+  parser.add_argument('--password', required=True)
+  parser.add_argument('--concurrency', type=int, default=100)
+  parser.add_argument('--requests', type=int, default=2000)
+  asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,77 @@
+"""Payroll aggregation, NumPy bincount vs a python loop, and loading the sales.
+
+Without --db the sales are synthetic and only the aggregation is timed.
+With --db the sales of the database configured in db_conn are loaded
+once through Row objects and once through payroll.load_sales (binary
+COPY on psycopg2), fetch time included. Run from the repository root:
+  python -m bench.payroll [sales] [masters] [--db]
+"""
+import argparse
+import time
+
+import numpy as np
+
+import payroll
+from payroll import aggregate
+
+
+def python_loop(rows):
+  revenue, counts = {}, {}
+  for master_id, price in rows:
+    revenue[master_id] = revenue.get(master_id, 0) + price
+    counts[master_id] = counts.get(master_id, 0) + 1
+  return counts, revenue
+
+
+def in_memory(sales: int, masters: int):
+  rng = np.random.default_rng(0)
+  rows = list(zip(rng.integers(1, masters + 1, sales).tolist(),
+                  rng.uniform(100, 5000, sales).round(2).tolist()))
+
+  started = time.perf_counter()
+  python_loop(rows)
+  loop = time.perf_counter() - started
+
+  started = time.perf_counter()
+  data = np.array(rows, dtype=np.float64).reshape(-1, 2)
+  aggregate(data[:, 0].astype(np.int64), data[:, 1], masters + 1)
+  vectorized = time.perf_counter() - started
+
+  print(f'{sales} sales, {masters} masters')
+  print(f'python loop : {loop * 1000:8.1f} ms')
+  print(f'numpy       : {vectorized * 1000:8.1f} ms (including row -> array conversion)')
+
+
+def from_database():
+  from db_conn import SessionLocal
+  db = SessionLocal()
+
+  started = time.perf_counter()
+  rows = db.execute(payroll.sales_stmt()).all()
+  data = np.array(rows, dtype=np.float64).reshape(-1, 2)
+  master_ids = data[:, 0].astype(np.int64)
+  aggregate(master_ids, data[:, 1], int(master_ids.max(initial=0)) + 1)
+  row_path = time.perf_counter() - started
+
+  started = time.perf_counter()
+  master_ids, prices = payroll.load_sales(db)
+  aggregate(master_ids, prices, int(master_ids.max(initial=0)) + 1)
+  column_path = time.perf_counter() - started
+  driver = db.get_bind().dialect.driver
+  db.close()
+
+  print(f'{len(rows)} sales in the database, fetch + aggregate')
+  print(f'row objects : {row_path * 1000:8.1f} ms')
+  print(f'load_sales  : {column_path * 1000:8.1f} ms ({driver})')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('sales', type=int, nargs='?', default=1_000_000)
+  parser.add_argument('masters', type=int, nargs='?', default=50)
+  parser.add_argument('--db', action='store_true')
+  args = parser.parse_args()
+  if args.db:
+    from_database()
+  else:
+    in_memory(args.sales, args.masters)
@@ -0,0 +1,51 @@
+"""Check read-replica routing against a running server.
+
+Start two local Postgres instances, point db_conn at the first and
+REPLICA_DATABASE_URLS at the second, then:
+
+  python -m bench.routing --url http://127.0.0.1:8000 --login admin --password secret
+
+Reads should go to a replica, reads right after a write to the primary
+until REPLICA_PIN_SECONDS have passed. Stop the replica to see the
+fallback to the primary.
+"""
+import argparse
+import time
+
+import httpx
+
+
+def route(client: httpx.Client, path: str) -> str:
+  r = client.get(path)
+  r.raise_for_status()
+  return r.headers.get('x-db-route', '-')
+
+
+def main(args):
+  with httpx.Client(base_url=args.url) as client:
+    r = client.post('/api/login', json={'login': args.login, 'password': args.password})
+    r.raise_for_status()
+    client.headers['Authorization'] = f'Bearer {r.json()["access_token"]}'
+
+    print(f'read               : {route(client, args.path)}')
+    client.post('/api/product', json={'id': 0, 'name': 'routing check'}).raise_for_status()
+    print(f'read after a write : {route(client, args.path)}')
+    time.sleep(args.pin + 0.5)
+    print(f'read {args.pin + 0.5:.1f} s later  : {route(client, args.path)}')
+    routes = {}
+    for _ in range(args.requests):
+      name = route(client, args.path)
+      routes[name] = routes.get(name, 0) + 1
+    print(f'{args.requests} reads       : {routes}')
+    print(client.get('/api/_stats').json().get('db_routing'))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--url', default='http://127.0.0.1:8000')
+  parser.add_argument('--login', required=True)
+  parser.add_argument('--password', required=True)
+  parser.add_argument('--path', default='/api/sale')
+  parser.add_argument('--pin', type=float, default=5, help='REPLICA_PIN_SECONDS of the server')
+  parser.add_argument('--requests', type=int, default=50)
+  main(parser.parse_args())
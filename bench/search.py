@@ -0,0 +1,60 @@
+"""Name search latency on a large products table, trigram index vs sequential scan.
+
+Fills products up to the requested size in the database configured in
+db_conn (postgres only), point it at a scratch database.
+Run from the repository root: python -m bench.search [rows]
+"""
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+
+import models as md
+import search
+from db_conn import SessionLocal
+
+TERMS = ['a1b', 'ff0', 'c3d4', '9e', 'abcdef', 'zz']
+
+
+def fill(db, rows: int):
+  have = db.query(md.Product).count()
+  if have >= rows:
+    return
+  user_id = db.query(md.User.id).scalar()
+  db.execute(text(
+      "INSERT INTO products (name, user_id) "
+      "SELECT md5(i::text), :user_id FROM generate_series(:start, :stop) i"
+  ), {'user_id': user_id, 'start': have + 1, 'stop': rows})
+  db.commit()
+  db.execute(text('ANALYZE products'))
+
+
+def measure(db, repeat: int = 20) -> list:
+  timings = []
+  for _ in range(repeat):
+    for term in TERMS:
+      started = time.perf_counter()
+      search.name_search(db.query(md.Product), md.Product.name, term, md.Product.id).limit(10).all()
+      timings.append((time.perf_counter() - started) * 1000)
+  return sorted(timings)
+
+
+def report(name: str, timings: list):
+  p95 = timings[int(len(timings) * 0.95) - 1]
+  print(f'{name:>10}: p50 {statistics.median(timings):8.2f} ms  p95 {p95:8.2f} ms')
+
+
+def main(rows: int = 1_000_000):
+  db = SessionLocal()
+  fill(db, rows)
+  report('trigram', measure(db))
+  db.execute(text('SET enable_bitmapscan = off'))
+  db.execute(text('SET enable_indexscan = off'))
+  report('seq scan', measure(db, repeat=3))
+  db.rollback()
+  db.close()
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:2]))
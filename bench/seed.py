@@ -0,0 +1,203 @@
+"""Synthetic data generator for every table in models.py.
+
+Fills an empty database with reproducible data at a given scale, using
+COPY on postgres and executemany INSERTs elsewhere. Point db_conn at a
+scratch database; --truncate empties the tables first.
+
+  python -m bench.seed --products 100000 --sales 1000000 --truncate
+"""
+import argparse
+import csv
+import io
+import random
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import text
+
+import auth
+import cogs
+import migrate
+import rollup
+import search  # creates pg_trgm ahead of the trigram indexes
+from db_conn import Base, SessionLocal, engine
+
+CHUNK = 50_000
+START = date(2019, 1, 1)
+CAUSES = ['damaged', 'expired', 'lost', 'defect']
+CARS = ['lada', 'kia rio', 'toyota camry', 'hyundai solaris', 'vw polo']
+SERVICES = ['oil change', 'brakes', 'diagnostics', 'tyres', 'suspension', None]
+
+
+def copy_rows(conn, table, rows):
+  """Load `rows` (dicts keyed by column name) in chunks."""
+  rows = iter(rows)
+  first = next(rows, None)
+  if first is None:
+    return
+  columns = list(first)
+  unknown = set(columns) - set(table.columns.keys())
+  if unknown:
+    raise ValueError(f'{table.name} has no column {", ".join(sorted(unknown))}')
+  chunk = [first]
+  for row in rows:
+    chunk.append(row)
+    if len(chunk) >= CHUNK:
+      _flush(conn, table, columns, chunk)
+      chunk = []
+  if chunk:
+    _flush(conn, table, columns, chunk)
+
+
+def _flush(conn, table, columns, chunk):
+  if conn.dialect.name != 'postgresql':
+    conn.execute(table.insert(), chunk)
+    return
+  buf = io.StringIO()
+  writer = csv.writer(buf)
+  for row in chunk:
+    writer.writerow(['\\N' if row[c] is None else row[c] for c in columns])
+  buf.seek(0)
+  cursor = conn.connection.cursor()
+  cursor.copy_expert(
+      f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')',
+      buf)
+
+
+def day(rnd: random.Random, days: int) -> date:
+  return START + timedelta(days=rnd.randrange(days))
+
+
+def generate(args):
+  # rows are dicts keyed by column name, copy_rows takes the column list
+  # from the first row of each table
+  rnd = random.Random(args.seed)
+  password = auth.get_hashed_password('password')
+  n_stock = min(args.stock, args.products * args.suppliers)
+  stock_price = [round(rnd.uniform(50, 5000), 2) for _ in range(n_stock)]
+  stock_unit = [1 + rnd.randrange(args.units) for _ in range(n_stock)]
+  stock_count = [rnd.randrange(0, 200) for _ in range(n_stock)]
+
+  def stock_lot(i):
+    # distinct (product, supplier) per lot keeps uq_stock_product_supplier_price
+    return 1 + i % args.products, 1 + (i // args.products) % args.suppliers
+
+  def user():
+    return 1 + rnd.randrange(args.users)
+
+  yield 'users', (
+      dict(id=i, login=f'user{i}', first_name=f'first{i}', middle_name=None,
+           last_name=f'last{i}', password=password, email=f'user{i}@example.com',
+           deleted=False)
+      for i in range(1, args.users + 1))
+  yield 'suppliers', (dict(id=i, name=f'supplier {i}', user_id=1)
+                      for i in range(1, args.suppliers + 1))
+  yield 'units', (dict(id=i, name=f'unit {i}', user_id=1) for i in range(1, args.units + 1))
+  yield 'masters', (
+      dict(id=i, name=f'master {i}', amount=round(rnd.uniform(0, 20000), 2),
+           percentage=round(rnd.uniform(0, 30), 1), user_id=1)
+      for i in range(1, args.masters + 1))
+  yield 'products', (
+      dict(id=i, name=f'product {i} {rnd.choice(["filter", "pad", "bulb", "belt", "oil"])}',
+           user_id=user())
+      for i in range(1, args.products + 1))
+  yield 'stock', (
+      dict(id=i + 1, product_id=stock_lot(i)[0], supplier_id=stock_lot(i)[1],
+           count=stock_count[i], price=stock_price[i], unit_id=stock_unit[i])
+      for i in range(n_stock))
+  yield 'arrivals', (
+      dict(id=i, supplier_id=stock_lot(j)[1], invoce_number=f'INV-{i // 20}',
+           date=day(rnd, args.days), manufacturer='acme', product_id=stock_lot(j)[0],
+           count=rnd.randrange(1, 50), unit_id=stock_unit[j],
+           purchase_price=round(stock_price[j] * 0.7, 2), retail_price=stock_price[j],
+           info='', status=1, user_id=user())
+      for i, j in ((i, rnd.randrange(n_stock)) for i in range(1, args.arrivals + 1)))
+  yield 'sales', (
+      dict(id=i, date=day(rnd, args.days), car_model=rnd.choice(CARS),
+           car_vin=f'VIN{i:014d}', master_id=1 + rnd.randrange(args.masters),
+           service=rnd.choice(SERVICES), price=round(rnd.uniform(500, 30000), 2),
+           user_id=user(), car_number=f'{i % 9999:04d}AB01')
+      for i in range(1, args.sales + 1))
+  yield 'sale_product_relationship', (
+      dict(sale_id=sale_id, stock_id=j + 1, count=rnd.randrange(1, 4), price=stock_price[j])
+      for sale_id in range(1, args.sales + 1)
+      for j in set(rnd.randrange(n_stock) for _ in range(rnd.randrange(0, 4))))
+  yield 'product_returns', (
+      dict(id=i, date=day(rnd, args.days), supplier_id=stock_lot(j)[1],
+           product_id=stock_lot(j)[0], count=1, invoce_number=f'RET-{i}',
+           price=stock_price[j], status=rnd.randrange(2), user_id=user())
+      for i, j in ((i, rnd.randrange(n_stock)) for i in range(1, args.returns + 1)))
+  yield 'disposals', (
+      dict(id=i, date=day(rnd, args.days), product_id=stock_lot(j)[0], count=1,
+           cause=rnd.choice(CAUSES), stock_id=j + 1, user_id=user())
+      for i, j in ((i, rnd.randrange(n_stock)) for i in range(1, args.disposals + 1)))
+  closed = [rnd.randrange(2) for _ in range(args.inventories)]
+  yield 'inventoryes', (
+      dict(id=i + 1, date=day(rnd, args.days), inventory_cause='monthly count', info='',
+           user_id=user(), status=closed[i])
+      for i in range(args.inventories))
+  yield 'inventory_lines', (
+      dict(id=line_id, inventory_id=i + 1, stock_id=j + 1,
+           counted=max(0, stock_count[j] + rnd.randrange(-2, 3)),
+           expected=stock_count[j] if closed[i] else None)
+      for line_id, (i, j) in enumerate((
+          (i, j) for i in range(args.inventories)
+          # distinct stock per inventory keeps uq_inventory_line
+          for j in rnd.sample(range(n_stock), min(n_stock, rnd.randrange(1, 2 * args.inventory_lines)))
+      ), start=1))
+
+
+def main(args):
+  if engine.dialect.name == 'postgresql':
+    # the deployed schema: constraints, trigram indexes and the
+    # refcache_versions rows and triggers come from the migrations
+    migrate.migrate()
+  else:
+    Base.metadata.create_all(engine)
+  with engine.begin() as conn:
+    if args.truncate:
+      # refcache_versions keeps counting up, so ETags handed out before
+      # the reseed never match a page of the new data
+      names = ', '.join(t.name for t in Base.metadata.sorted_tables
+                        if t.name != 'refcache_versions')
+      conn.execute(text(f'TRUNCATE {names} RESTART IDENTITY CASCADE'))
+    tables = {t.name: t for t in Base.metadata.sorted_tables}
+    for name, rows in generate(args):
+      started = time.perf_counter()
+      copy_rows(conn, tables[name], rows)
+      print(f'{name:>26}: {time.perf_counter() - started:7.1f} s')
+    if conn.dialect.name == 'postgresql':
+      for table in tables.values():
+        if 'id' in table.columns:
+          conn.execute(text(
+              f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+              f"(SELECT coalesce(max(id), 1) FROM {table.name}))"))
+  # derived tables are computed from the seeded movements the way the
+  # application computes them
+  db = SessionLocal()
+  for name, rebuild in (('sale_rollups', rollup.rebuild), ('cost tables', cogs.rebuild)):
+    started = time.perf_counter()
+    rebuild(db)
+    print(f'{name:>26}: {time.perf_counter() - started:7.1f} s')
+  db.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--days', type=int, default=3 * 365)
+  parser.add_argument('--users', type=int, default=20)
+  parser.add_argument('--suppliers', type=int, default=200)
+  parser.add_argument('--units', type=int, default=10)
+  parser.add_argument('--masters', type=int, default=50)
+  parser.add_argument('--products', type=int, default=20_000)
+  parser.add_argument('--stock', type=int, default=50_000)
+  parser.add_argument('--arrivals', type=int, default=200_000)
+  parser.add_argument('--sales', type=int, default=200_000)
+  parser.add_argument('--returns', type=int, default=10_000)
+  parser.add_argument('--disposals', type=int, default=10_000)
+  parser.add_argument('--inventories', type=int, default=1_000)
+  parser.add_argument('--inventory-lines', type=int, default=20,
+                      help='average lines per inventory')
+  parser.add_argument('--truncate', action='store_true')
+  main(parser.parse_args())
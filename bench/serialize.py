@@ -0,0 +1,70 @@
+"""CPU profile of list-page serialization, ORM objects vs row projection.
+
+No database needed, the pages are built in memory.
+Run from the repository root: python -m bench.serialize [rows]
+"""
+import cProfile
+import pstats
+import sys
+from datetime import date
+
+from fastapi.encoders import jsonable_encoder
+
+import models as md
+import serializer
+from resources import arrival_rows, sale_rows
+
+
+def arrivals(n: int):
+  objects, rows = [], []
+  for i in range(n):
+    a = md.Arrival(id=i, supplier_id=i % 40, invoce_number=f'INV-{i // 20}',
+                   date=date(2022, 1 + i % 12, 1 + i % 28), manufacturer='acme',
+                   product_id=i % 900, count=3, unit_id=i % 5,
+                   purchase_price=10.5, retail_price=14.0, info='', status=1,
+                   user_id=1)
+    a.product = md.Product(id=a.product_id, name=f'product {a.product_id}')
+    a.unit = md.Unit(id=a.unit_id, name='pcs')
+    a.supplier = md.Supplier(id=a.supplier_id, name=f'supplier {a.supplier_id}')
+    objects.append(a)
+    rows.append(tuple(getattr(a, k) for k in arrival_rows.fields)
+                + (a.product.name, a.unit.name, a.supplier.name))
+  return objects, rows
+
+
+def sales(n: int):
+  objects, rows = [], []
+  for i in range(n):
+    s = md.Sale(id=i, date=date(2022, 1 + i % 12, 1 + i % 28), car_model='lada',
+                car_vin=f'VIN{i:014d}', master_id=i % 12, service='oil',
+                price=1200.0, user_id=1, car_number=f'{i % 9999:04d}AB01')
+    s.master = md.Master(id=s.master_id, name=f'master {s.master_id}')
+    s.user = md.User(id=1, login='admin')
+    objects.append(s)
+    rows.append(tuple(getattr(s, k) for k in sale_rows.fields)
+                + (s.master.name, s.user.login))
+  return objects, rows
+
+
+def profile(title: str, fn, repeat: int = 20):
+  profiler = cProfile.Profile()
+  profiler.enable()
+  for _ in range(repeat):
+    fn()
+  profiler.disable()
+  print(f'==== {title}')
+  pstats.Stats(profiler).sort_stats('cumulative').print_stats(8)
+
+
+def main(n: int = 1000):
+  for name, build, row_map in (('get_arrival_all', arrivals, arrival_rows),
+                               ('get_sale_all', sales, sale_rows)):
+    objects, rows = build(n)
+    profile(f'{name} before: ORM objects + jsonable_encoder',
+            lambda: serializer.dumps(jsonable_encoder({'items': objects})))
+    profile(f'{name} after: row tuples + RowMap',
+            lambda: serializer.dumps({'items': row_map.to_dicts(rows)}))
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:2]))
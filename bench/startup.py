@@ -0,0 +1,80 @@
+"""Cold-start benchmark: import time and time to first request.
+
+Every measurement runs in a fresh interpreter, so nothing is cached
+between runs. No database needed unless AUTO_CREATE_SCHEMA=1. Write a
+baseline and compare later runs against it; --max-regression makes the
+run fail when a median got slower by more than that many percent:
+
+  python -m bench.startup --out startup.json
+  python -m bench.startup --compare startup.json --max-regression 20
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+SNIPPETS = {
+    'import models': 'import models',
+    # the CLI path, the only one that skips the pydantic model generation
+    'import migrate': 'import migrate',
+    'import main': 'import main',
+    # startup events plus the first request, which also builds the OpenAPI schema
+    'first request': (
+        'import main\n'
+        'from fastapi.testclient import TestClient\n'
+        'with TestClient(main.app) as client:\n'
+        '  client.get("/openapi.json").raise_for_status()\n'),
+}
+
+TIMER = '''
+import time
+started = time.perf_counter()
+{code}
+print(time.perf_counter() - started)
+'''
+
+
+def measure(code: str, runs: int) -> dict:
+  times = []
+  for _ in range(runs):
+    out = subprocess.run([sys.executable, '-c', TIMER.format(code=code)],
+                         capture_output=True, text=True, check=True).stdout
+    times.append(float(out.split()[-1]) * 1000)
+  return {'median_ms': statistics.median(times), 'min_ms': min(times), 'max_ms': max(times)}
+
+
+def compare(old: dict, new: dict, max_regression: float) -> bool:
+  ok = True
+  print(f'\n{"step":<16} {"before":>10} {"after":>10} {"change":>8}')
+  for name, res in new.items():
+    before = old.get(name)
+    if before is None:
+      continue
+    change = (res['median_ms'] - before['median_ms']) / before['median_ms'] * 100
+    flag = ''
+    if max_regression is not None and change > max_regression:
+      ok, flag = False, '  REGRESSION'
+    print(f'{name:<16} {before["median_ms"]:>10.1f} {res["median_ms"]:>10.1f} {change:>+7.1f}%{flag}')
+  return ok
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--out', help='write results as JSON')
+  parser.add_argument('--compare', help='JSON of an earlier run')
+  parser.add_argument('--max-regression', type=float, help='fail above this slowdown, in percent')
+  args = parser.parse_args()
+  report = {}
+  for name, code in SNIPPETS.items():
+    report[name] = measure(code, args.runs)
+    print(f'{name:<16} median {report[name]["median_ms"]:8.1f} ms '
+          f'(min {report[name]["min_ms"]:.1f}, max {report[name]["max_ms"]:.1f})')
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(report, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      if not compare(json.load(f), report, args.max_regression):
+        sys.exit(1)
@@ -0,0 +1,83 @@
+"""Concurrent decrements of one stock row, read-modify-write vs guarded UPDATE.
+
+Writes into the database configured in db_conn, point it at a scratch
+database. Run from the repository root:
+  python -m bench.stock_contention [threads] [spends_per_thread]
+"""
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+
+import models as md
+import stock_service
+from db_conn import SessionLocal
+
+
+def legacy_spend(db, stock_id: int, n: float) -> bool:
+  # the former product_return_spend: read, check in python, write back
+  stock = db.get(md.Stock, stock_id)
+  if stock.count < n:
+    db.rollback()
+    return False
+  stock.count -= n
+  db.commit()
+  return True
+
+
+def guarded_spend(db, stock_id: int, n: float) -> bool:
+  try:
+    stock_service.spend(db, {stock_id: n})
+  except HTTPException:
+    return False
+  db.commit()
+  return True
+
+
+def make_stock(initial: float) -> int:
+  db = SessionLocal()
+  user_id = db.query(md.User.id).scalar()
+  product = md.Product(name='contention', user_id=user_id)
+  supplier = md.Supplier(name='contention', user_id=user_id)
+  unit = md.Unit(name='contention', user_id=user_id)
+  db.add_all([product, supplier, unit])
+  db.flush()
+  stock = md.Stock(product_id=product.id, supplier_id=supplier.id,
+                   unit_id=unit.id, count=initial, price=time.time())
+  db.add(stock)
+  db.commit()
+  stock_id = stock.id
+  db.close()
+  return stock_id
+
+
+def run(spend, threads: int, per_thread: int):
+  initial = threads * per_thread // 2
+  stock_id = make_stock(initial)
+
+  def worker(_):
+    db = SessionLocal()
+    ok = sum(spend(db, stock_id, 1) for _ in range(per_thread))
+    db.close()
+    return ok
+
+  started = time.perf_counter()
+  with ThreadPoolExecutor(threads) as pool:
+    succeeded = sum(pool.map(worker, range(threads)))
+  elapsed = time.perf_counter() - started
+  db = SessionLocal()
+  final = db.get(md.Stock, stock_id).count
+  db.close()
+  lost = (initial - succeeded) - final
+  print(f'{spend.__name__:>14}: {succeeded} spends ok, stock {initial} -> {final:g}, '
+        f'lost updates {lost:g}, {threads * per_thread / elapsed:.0f} attempts/s')
+
+
+def main(threads: int = 32, per_thread: int = 50):
+  run(legacy_spend, threads, per_thread)
+  run(guarded_spend, threads, per_thread)
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:3]))
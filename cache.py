@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache:
+  """Bounded LRU cache whose entries expire after `ttl` seconds."""
+
+  def __init__(self, maxsize: int = 1024, ttl: float = 60):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._data = OrderedDict()
+    self._lock = Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      value, expires = entry
+      if expires < time.monotonic():
+        del self._data[key]
+        self.misses += 1
+        return default
+      self._data.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def set(self, key, value, ttl: float = None):
+    expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+    with self._lock:
+      self._data[key] = (value, expires)
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+
+  def pop(self, key):
+    with self._lock:
+      entry = self._data.pop(key, None)
+    return None if entry is None else entry[0]
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def __len__(self):
+    return len(self._data)
+
+  def stats(self) -> dict:
+    total = self.hits + self.misses
+    return {
+        'size': len(self._data),
+        'maxsize': self.maxsize,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / total if total else 0.0,
+    }
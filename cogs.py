@@ -0,0 +1,161 @@
+"""FIFO cost of goods sold per sale and per period.
+
+Arrivals open cost layers per product at their purchase price; sale
+lines, spent supplier returns and disposals consume the oldest layers
+first (see fifo). Writes to the movement tables queue the product in
+cost_changes (migrations/0005_cost_changes.sql). `update` takes the
+queued products and replays each one's whole history in (date, kind,
+id) order, so new documents, PUTs, deletes, backdated documents and
+transactions that commit after a later one are all costed as if
+replayed from scratch. It stores:
+
+- md.SaleCost: revenue (line count * line price) and COGS per sale and product,
+- md.CostLayer: the open layers of every replayed product.
+
+The reports read what the last update stored. `POST /api/report/cogs/refresh`,
+`python -m cogs update` or a cron job run an update; `python -m cogs
+rebuild` replays every product.
+"""
+import sys
+from datetime import date as dt_date
+from typing import Union
+
+from fastapi import APIRouter, Depends
+from fastapi.exceptions import HTTPException
+from sqlalchemy import delete, func, insert, literal, select, union_all
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import deps
+import fifo
+import filters
+import models as md
+from db_conn import get_db
+from fifo import ARRIVAL, DISPOSAL, PRODUCT_RETURN, SALE
+
+router = APIRouter()
+
+BATCH = 5000
+LOCK_ID = 7_202_420
+
+link = md.sale_product_relationship
+
+
+def movements(product_ids: list):
+  """(date, kind, doc_id, product_id, count, price) of the products in replay order."""
+  arrivals = select(md.Arrival.date, literal(ARRIVAL).label('kind'), md.Arrival.id,
+                    md.Arrival.product_id, md.Arrival.count, md.Arrival.purchase_price) \
+      .where(md.Arrival.product_id.in_(product_ids))
+  sales = select(md.Sale.date, literal(SALE), md.Sale.id, md.Stock.product_id,
+                 func.coalesce(link.c.count, 1), func.coalesce(link.c.price, md.Stock.price)) \
+      .select_from(link) \
+      .join(md.Sale, md.Sale.id == link.c.sale_id) \
+      .join(md.Stock, md.Stock.id == link.c.stock_id) \
+      .where(md.Stock.product_id.in_(product_ids))
+  returns = select(md.ProductReturn.date, literal(PRODUCT_RETURN), md.ProductReturn.id,
+                   md.ProductReturn.product_id, md.ProductReturn.count, md.ProductReturn.price) \
+      .where(md.ProductReturn.product_id.in_(product_ids), md.ProductReturn.status == 1)
+  disposals = select(md.Disposal.date, literal(DISPOSAL), md.Disposal.id,
+                     md.Disposal.product_id, md.Disposal.count, literal(0.0)) \
+      .where(md.Disposal.product_id.in_(product_ids))
+  u = union_all(arrivals, sales, returns, disposals).subquery()
+  return select(u).order_by(u.c.product_id, u.c.date, u.c.kind, u.c.id)
+
+
+def _insert(db: Session, model, rows: list):
+  for i in range(0, len(rows), BATCH):
+    db.execute(postgresql.insert(model).values(rows[i:i + BATCH]))
+
+
+def update(db: Session) -> dict:
+  """Replay the products queued in cost_changes and commit the results."""
+  # concurrent updates run one after another; writers never wait for it
+  db.execute(select(func.pg_advisory_xact_lock(LOCK_ID)))
+  # a write that commits after this statement leaves its rows queued for
+  # the next update, even if the replay below already sees it
+  changed = sorted(set(db.execute(
+      delete(md.cost_changes).returning(md.cost_changes.c.product_id)).scalars()))
+  processed = 0
+  sales = set()
+  for i in range(0, len(changed), BATCH):
+    product_ids = changed[i:i + BATCH]
+    rows = db.execute(movements(product_ids)).all()
+    processed += len(rows)
+    ledger, lines = fifo.replay(rows)
+    db.execute(delete(md.SaleCost).where(md.SaleCost.product_id.in_(product_ids)))
+    db.execute(delete(md.CostLayer).where(md.CostLayer.product_id.in_(product_ids)))
+    _insert(db, md.SaleCost, list(lines.values()))
+    _insert(db, md.CostLayer, [r for product_id in product_ids for r in ledger.rows(product_id)])
+    sales.update(sale_id for sale_id, _ in lines)
+  db.commit()
+  return {'movements': processed, 'sales': len(sales), 'products': len(changed)}
+
+
+def rebuild(db: Session) -> dict:
+  db.execute(select(func.pg_advisory_xact_lock(LOCK_ID)))
+  for model in (md.SaleCost, md.CostLayer):
+    db.execute(delete(model))
+  db.execute(insert(md.cost_changes).from_select(['product_id'], select(md.Product.id)))
+  return update(db)
+
+
+def report(db: Session, from_date: dt_date = None, to_date: dt_date = None,
+           daily: bool = False) -> list:
+  group = [md.SaleCost.date] if daily else []
+  q = db.query(*group,
+               func.count(func.distinct(md.SaleCost.sale_id)).label('sales'),
+               func.coalesce(func.sum(md.SaleCost.revenue), 0).label('revenue'),
+               func.coalesce(func.sum(md.SaleCost.cogs), 0).label('cogs'),
+               func.coalesce(func.sum(md.SaleCost.uncosted), 0).label('uncosted'))
+  q = filters.between(q, md.SaleCost.date, from_date, to_date)
+  if daily:
+    q = q.group_by(*group).order_by(*group)
+  result = []
+  for row in q:
+    data = dict(row._mapping)
+    data['margin'] = data['revenue'] - data['cogs']
+    data['margin_pct'] = data['margin'] / data['revenue'] * 100 if data['revenue'] else None
+    result.append(data)
+  return result
+
+
+@router.get("/api/report/cogs")
+def report_cogs(from_date: Union[dt_date, None] = None,
+                to_date: Union[dt_date, None] = None,
+                daily: bool = False,
+                user: md.User = Depends(deps.auth_middleware), db: Session = Depends(get_db)):
+  return report(db, from_date, to_date, daily)
+
+
+@router.post("/api/report/cogs/refresh")
+def refresh_cogs(user: md.User = Depends(deps.auth_middleware), db: Session = Depends(get_db)):
+  return update(db)
+
+
+@router.get("/api/sale/{item_id}/cost")
+def get_sale_cost(item_id: int,
+                  user: md.User = Depends(deps.auth_middleware), db: Session = Depends(get_db)):
+  cost = db.query(func.min(md.SaleCost.date).label('date'),
+                  func.sum(md.SaleCost.revenue).label('revenue'),
+                  func.sum(md.SaleCost.cogs).label('cogs'),
+                  func.sum(md.SaleCost.uncosted).label('uncosted')) \
+      .filter(md.SaleCost.sale_id == item_id).one()
+  if cost.date is None:
+    raise HTTPException(status_code=404, detail="Sale cost not found")
+  return {
+      'sale_id': item_id,
+      'date': cost.date,
+      'revenue': cost.revenue,
+      'cogs': cost.cogs,
+      'margin': cost.revenue - cost.cogs,
+      'uncosted': cost.uncosted,
+  }
+
+
+if __name__ == '__main__':
+  if sys.argv[1:] not in (['update'], ['rebuild']):
+    sys.exit('usage: python -m cogs update|rebuild')
+  from db_conn import SessionLocal
+  session = SessionLocal()
+  print((rebuild if sys.argv[1] == 'rebuild' else update)(session))
+  session.close()
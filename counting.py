@@ -0,0 +1,106 @@
+"""Total counts for paginated lists: exact, cached or estimated.
+
+The strategy is chosen per list endpoint, by the table it pages over:
+
+- exact: SELECT count(*) over the filtered query,
+- cached: the exact count kept COUNT_CACHE_TTL seconds per compiled
+  query, i.e. per normalized set of filters,
+- estimated: the planner's row estimate from EXPLAIN (postgres only,
+  exact elsewhere). Estimates under COUNT_EXACT_BELOW are replaced by an
+  exact count, which is cheap at that size.
+
+Defaults are in DEFAULTS and can be overridden with
+COUNT_STRATEGIES="arrivals=cached,stock=estimated".
+"""
+import hashlib
+import json
+import os
+from typing import Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Query, Session
+
+from cache import TTLCache
+
+EXACT = 'exact'
+CACHED = 'cached'
+ESTIMATED = 'estimated'
+STRATEGIES = (EXACT, CACHED, ESTIMATED)
+
+COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', 30))
+COUNT_EXACT_BELOW = int(os.environ.get('COUNT_EXACT_BELOW', 1000))
+
+DEFAULTS = {
+    'arrivals': ESTIMATED,
+    'sales': ESTIMATED,
+}
+
+
+def _parse(value: str) -> dict:
+  result = {}
+  for item in filter(None, (x.strip() for x in value.split(','))):
+    table, _, name = item.partition('=')
+    if name not in STRATEGIES:
+      raise ValueError(f'COUNT_STRATEGIES: unknown strategy {name!r} for {table}')
+    result[table] = name
+  return result
+
+
+strategies = dict(DEFAULTS, **_parse(os.environ.get('COUNT_STRATEGIES', '')))
+counts = TTLCache(maxsize=4096, ttl=COUNT_CACHE_TTL)
+
+
+def strategy(keys: list) -> str:
+  """Strategy of the endpoint paging on `keys`, by the table of its last key."""
+  return strategies.get(keys[-1][0].table.name, EXACT)
+
+
+def _statement(q):
+  stmt = q.statement if isinstance(q, Query) else q
+  return stmt.order_by(None)
+
+
+def _compile(session: Session, stmt, params: dict = None):
+  compiled = stmt.compile(dialect=session.get_bind().dialect,
+                          compile_kwargs={'render_postcompile': True})
+  params = compiled.construct_params(params)
+  if compiled.positional:
+    params = tuple(params[name] for name in compiled.positiontup)
+  return str(compiled), params
+
+
+def exact(session: Session, q, params: dict = None) -> int:
+  return session.execute(select(func.count()).select_from(_statement(q).subquery()), params).scalar()
+
+
+def cached(session: Session, q, params: dict = None) -> int:
+  sql, values = _compile(session, _statement(q), params)
+  key = hashlib.sha1(f'{sql}\0{values!r}'.encode()).hexdigest()
+  n = counts.get(key)
+  if n is None:
+    n = exact(session, q, params)
+    counts.set(key, n)
+  return n
+
+
+def estimated(session: Session, q, params: dict = None) -> int:
+  sql, params = _compile(session, _statement(q), params)
+  plan = session.connection().exec_driver_sql(f'EXPLAIN (FORMAT JSON) {sql}', params).scalar()
+  if isinstance(plan, str):
+    # asyncpg does not decode json
+    plan = json.loads(plan)
+  return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count(session: Session, q, name: str = EXACT, params: dict = None) -> Tuple[int, str]:
+  """(total, strategy actually used) for the rows of `q`.
+
+  `params` are the values of the bindparams in `q`, if it has any.
+  """
+  if name == ESTIMATED and session.get_bind().dialect.name == 'postgresql':
+    n = estimated(session, q, params)
+    if n >= COUNT_EXACT_BELOW:
+      return n, ESTIMATED
+  if name == CACHED:
+    return cached(session, q, params), CACHED
+  return exact(session, q, params), EXACT
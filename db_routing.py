@@ -0,0 +1,179 @@
+"""Read-replica routing for read-only endpoints.
+
+REPLICA_DATABASE_URLS is a comma separated list of replica URLs of the
+db_conn database. Endpoints that take their session from get_read_db
+are served by a replica, round robin, unless
+
+- the client wrote something less than REPLICA_PIN_SECONDS ago, so it
+  reads its own writes. Any successful non-GET request answers with the
+  write time in a db_written cookie and an X-DB-Written response header;
+  a request that carries either one back is pinned to the primary
+  whichever worker or host serves it. Clients that do not keep cookies
+  echo the header. The worker that served the write also remembers the
+  client's Authorization for the same time.
+- or no replica is within REPLICA_MAX_LAG seconds of the primary; lag
+  is checked at most every REPLICA_LAG_CHECK_INTERVAL seconds per
+  replica and an unreachable replica counts as lagging. The check runs
+  in the request that finds the value stale, so replica connections
+  give up after REPLICA_CONNECT_TIMEOUT seconds instead of holding the
+  request for the TCP timeout.
+
+In both cases the request falls back to the db_conn primary. Replica
+sessions are read only, and the X-DB-Route response header names the
+database that served the request. Without replicas everything stays on
+the primary. Two independent local instances work for testing: a
+server that is not in recovery reports no lag.
+"""
+import hashlib
+import itertools
+import os
+import time
+from functools import partial
+from threading import Lock
+
+from fastapi import FastAPI, Request
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from cache import TTLCache
+from db_conn import SessionLocal
+
+REPLICA_URLS = [x.strip() for x in os.environ.get('REPLICA_DATABASE_URLS', '').split(',') if x.strip()]
+REPLICA_PIN_SECONDS = float(os.environ.get('REPLICA_PIN_SECONDS', 5))
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 2))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 1))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+WRITTEN_COOKIE = 'db_written'
+WRITTEN_HEADER = 'x-db-written'
+
+LAG_SQL = text(
+    "SELECT CASE"
+    " WHEN NOT pg_is_in_recovery() THEN 0"
+    " WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)"
+    " END")
+
+replicas = [
+    create_engine(
+        url,
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        pool_pre_ping=True,
+        connect_args={'connect_timeout': REPLICA_CONNECT_TIMEOUT},
+        execution_options={'postgresql_readonly': True},
+    )
+    for url in REPLICA_URLS
+]
+ReplicaSession = sessionmaker(autocommit=False, autoflush=False)
+
+pins = TTLCache(maxsize=100_000, ttl=REPLICA_PIN_SECONDS)
+_lag = {}
+_lock = Lock()
+_round_robin = itertools.count()
+_routes = {}
+
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+def client_key(request: Request) -> str:
+  token = request.headers.get('authorization') or (request.client.host if request.client else '')
+  return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _written_at(request: Request):
+  value = request.headers.get(WRITTEN_HEADER) or request.cookies.get(WRITTEN_COOKIE)
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+
+def pinned(request: Request) -> bool:
+  written = _written_at(request)
+  # a time in the future is ignored, it could pin a client forever
+  if written is not None and 0 <= time.time() - written < REPLICA_PIN_SECONDS:
+    return True
+  return pins.get(client_key(request)) is not None
+
+
+def replica_lag(index: int):
+  """Seconds replica `index` is behind, None if it can not be reached."""
+  now = time.monotonic()
+  with _lock:
+    checked, lag = _lag.get(index, (None, None))
+    if checked is not None and now - checked < REPLICA_LAG_CHECK_INTERVAL:
+      return lag
+    # claim the check so concurrent requests reuse the previous value
+    _lag[index] = (now, lag)
+  try:
+    with replicas[index].connect() as conn:
+      lag = float(conn.execute(LAG_SQL).scalar())
+  except Exception:
+    lag = None
+  with _lock:
+    _lag[index] = (time.monotonic(), lag)
+  return lag
+
+
+def pick_replica():
+  """Index of the next replica within REPLICA_MAX_LAG, None if there is none."""
+  start = next(_round_robin)
+  for i in range(len(replicas)):
+    index = (start + i) % len(replicas)
+    lag = replica_lag(index)
+    if lag is not None and lag <= REPLICA_MAX_LAG:
+      return index
+  return None
+
+
+def _count(route: str):
+  with _lock:
+    _routes[route] = _routes.get(route, 0) + 1
+
+
+def read_sessions(request: Request):
+  """Session factory of the database that serves the request, see the module docstring.
+
+  For bodies that outlive the request's dependencies (streaming), the
+  caller opens and closes the session itself.
+  """
+  index = None if not replicas or pinned(request) else pick_replica()
+  if index is None:
+    request.state.db_route = 'primary'
+    _count('primary')
+    return SessionLocal
+  request.state.db_route = f'replica{index}'
+  _count(request.state.db_route)
+  return partial(ReplicaSession, bind=replicas[index])
+
+
+def get_read_db(request: Request):
+  """Session dependency for read-only endpoints, see the module docstring."""
+  db = read_sessions(request)()
+  try:
+    yield db
+  finally:
+    db.close()
+
+
+def stats() -> dict:
+  with _lock:
+    lag = {f'replica{i}': value for i, (_, value) in sorted(_lag.items())}
+    routes = dict(_routes)
+  return {'replicas': len(replicas), 'lag': lag, 'requests': routes, 'pinned_clients': len(pins)}
+
+
+def install(app: FastAPI):
+  @app.middleware('http')
+  async def replica_pinning(request: Request, call_next):
+    response = await call_next(request)
+    if request.method in WRITE_METHODS and response.status_code < 400:
+      pins.set(client_key(request), True)
+      written = f'{time.time():.3f}'
+      response.headers['X-DB-Written'] = written
+      response.set_cookie(WRITTEN_COOKIE, written, max_age=max(1, int(REPLICA_PIN_SECONDS)),
+                          httponly=True, samesite='lax')
+    route = getattr(request.state, 'db_route', None)
+    if route is not None:
+      response.headers['X-DB-Route'] = route
+    return response
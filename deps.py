@@ -1,7 +1,12 @@
-from typing import Union, Any
+import os
+import hashlib
+from collections import namedtuple
+from typing import Union
 from datetime import datetime
 from fastapi import Depends, HTTPException, status
-from sqlalchemy.orm import Session, undefer, defer
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
 from fastapi.security import OAuth2PasswordBearer
 from auth import (
     ALGORITHM,
@@ -15,82 +20,153 @@ from jose import jwt
 from pydantic import ValidationError
 import models as md
 from db_conn import get_db
+from db_async import get_async_db
 from fastapi import Request
+from cache import TTLCache
 
 reuseable_oauth = OAuth2PasswordBearer(
     tokenUrl="/api/login_form",
     scheme_name="JWT"
 )
 
+CachedUser = namedtuple('CachedUser', ['id', 'login', 'deleted'])
 
-def auth_middleware(requset: Request, db: Session = Depends(get_db), token: str = Depends(reuseable_oauth)) -> md.User:
-  try:
-    payload = jwt.decode(
-        token, JWT_SECRET_KEY, algorithms=[ALGORITHM]
+# user id -> CachedUser, saves the users lookup on every protected request
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 300)),
+)
+
+# token digest -> verified TokenPayload, entries live until the token's exp
+token_cache = TTLCache(
+    maxsize=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+)
+
+
+def invalidate_user(user_id: int):
+  user_cache.pop(user_id)
+
+
+@event.listens_for(md.User, 'after_insert')
+@event.listens_for(md.User, 'after_update')
+@event.listens_for(md.User, 'after_delete')
+def _user_changed(mapper, connection, target: md.User):
+  # flushed, not committed yet: a request reading the user now would
+  # cache the old row again, so the ids are dropped after the commit
+  session = object_session(target)
+  if session is not None:
+    session.info.setdefault('changed_users', set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _users_committed(session: Session):
+  for user_id in session.info.pop('changed_users', ()):
+    invalidate_user(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _users_rolled_back(session: Session):
+  session.info.pop('changed_users', None)
+
+
+def check_user(user) -> None:
+  if user is None:
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="Could not find user",
+    )
+  if user.deleted:
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="User is deleted",
+        headers={"WWW-Authenticate": "Bearer"},
     )
-    token_data = md.TokenPayload(**payload)
-    if token_data.token_type != "access":
+
+
+def get_cached_user(user_id: int, db: Session) -> Union[CachedUser, None]:
+  user = user_cache.get(user_id)
+  if user is not None:
+    return user
+  row = db.query(md.User.id, md.User.login, md.User.deleted).filter(
+      md.User.id == user_id).first()
+  if row is None:
+    return None
+  user = CachedUser(*row)
+  user_cache.set(user_id, user)
+  return user
+
+
+async def get_cached_user_async(user_id: int, db: AsyncSession) -> Union[CachedUser, None]:
+  user = user_cache.get(user_id)
+  if user is not None:
+    return user
+  row = (await db.execute(select(md.User.id, md.User.login, md.User.deleted).where(
+      md.User.id == user_id))).first()
+  if row is None:
+    return None
+  user = CachedUser(*row)
+  user_cache.set(user_id, user)
+  return user
+
+
+def verify_token(token: str, secret: str, token_type: str) -> md.TokenPayload:
+  key = hashlib.sha256(f'{token_type}:{token}'.encode()).digest()
+  token_data: md.TokenPayload = token_cache.get(key)
+  if token_data is None:
+    try:
+      payload = jwt.decode(
+          token, secret, algorithms=[ALGORITHM]
+      )
+      token_data = md.TokenPayload(**payload)
+    except (jwt.JWTError, ValidationError):
       raise HTTPException(
           status_code=status.HTTP_401_UNAUTHORIZED,
-          detail="token_type is filed",
+          detail="Could not validate credentials",
           headers={"WWW-Authenticate": "Bearer"},
       )
-    # print(token_data)
-    if datetime.fromtimestamp(token_data.exp) < datetime.now():
+    if token_data.token_type != token_type:
       raise HTTPException(
           status_code=status.HTTP_401_UNAUTHORIZED,
-          detail="Token expired",
+          detail="token_type is filed",
           headers={"WWW-Authenticate": "Bearer"},
       )
-  except (jwt.JWTError, ValidationError):
+    # keep the verified payload only until the token itself expires
+    ttl = token_data.exp - datetime.now().timestamp()
+    if ttl > 0:
+      token_cache.set(key, token_data, ttl=ttl)
+  if datetime.fromtimestamp(token_data.exp) < datetime.now():
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
+        detail="Token expired",
         headers={"WWW-Authenticate": "Bearer"},
     )
-  # print(requset.url.path )
+  return token_data
+
+
+def auth_middleware(requset: Request, db: Session = Depends(get_db), token: str = Depends(reuseable_oauth)) -> md.User:
+  token_data = verify_token(token, JWT_SECRET_KEY, "access")
   if requset.url.path == '/api/me':
     user: md.User = db.query(md.User) .filter(
         md.User.id == token_data.user_id).first()
   else:
-    user: md.User = db.query(md.User.id) .filter(
-        md.User.id == token_data.user_id).first()
+    user = get_cached_user(token_data.user_id, db)
+
+  check_user(user)
+  return user
 
-  if user is None:
-    raise HTTPException(
-        status_code=status.HTTP_404_NOT_FOUND,
-        detail="Could not find user",
-    )
 
+async def auth_middleware_async(db: AsyncSession = Depends(get_async_db),
+                                token: str = Depends(reuseable_oauth)) -> CachedUser:
+  """auth_middleware of the async routes, reads the user on the request's AsyncSession."""
+  token_data = verify_token(token, JWT_SECRET_KEY, "access")
+  user = await get_cached_user_async(token_data.user_id, db)
+  check_user(user)
   return user
 
 
 def auth_refresh_token(db: Session = Depends(get_db), token: str = Depends(reuseable_oauth)) -> dict:
-  try:
-    payload = jwt.decode(
-        token, JWT_REFRESH_SECRET_KEY, algorithms=[ALGORITHM]
-    )
-    token_data = md.TokenPayload(**payload)
-    if token_data.token_type != "refresh":
-      raise HTTPException(
-          status_code=status.HTTP_401_UNAUTHORIZED,
-          detail="token_type is filed",
-          headers={"WWW-Authenticate": "Bearer"},
-      )
-    # print(token_data)
-    if datetime.fromtimestamp(token_data.exp) < datetime.now():
-      raise HTTPException(
-          status_code=status.HTTP_401_UNAUTHORIZED,
-          detail="Token expired",
-          headers={"WWW-Authenticate": "Bearer"},
-      )
-  except (jwt.JWTError, ValidationError) as e:
-    print(e)
-    raise HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+  token_data = verify_token(token, JWT_REFRESH_SECRET_KEY, "refresh")
+  check_user(get_cached_user(token_data.user_id, db))
 
   return {
       "access_token":  create_access_token(token_data.user_id),
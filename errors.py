@@ -0,0 +1,19 @@
+from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse
+
+item_not_foud = {"error": "item not found"}
+
+
+def check_item_not_found(item):
+  if item is None:
+    return JSONResponse(item_not_foud, status_code=404)
+  return item
+
+
+def error_response(e):
+  # try:
+  err: str = e.args.__getitem__(0)
+  ind = err.index('DETAIL')
+  if ind == -1:
+    ind = 0
+  raise HTTPException(status_code=400, detail=err[ind:])
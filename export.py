@@ -0,0 +1,200 @@
+"""Streaming CSV / NDJSON export of documents.
+
+Rows are projected to plain columns and read through a server-side
+cursor, so memory use does not depend on the size of the date range.
+The body streams after the request's dependencies are torn down, so
+the rows are read on a session the generator opens and closes itself.
+"""
+import csv
+import io
+import json
+from datetime import date as dt_date
+from typing import Union
+
+from fastapi import APIRouter, Depends
+from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, select
+
+import deps
+import filters
+import models as md
+from db_routing import read_sessions
+
+router = APIRouter()
+
+YIELD_PER = 1000
+FLUSH_BYTES = 64 * 1024
+
+MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def stream_rows(open_session, stmt, fmt: str):
+  db = open_session()
+  try:
+    result = db.execute(stmt.execution_options(stream_results=True))
+    keys = list(result.keys())
+    rows = (row for part in result.partitions(YIELD_PER) for row in part)
+    if fmt == 'ndjson':
+      for row in rows:
+        yield json.dumps(dict(zip(keys, row)), default=str, ensure_ascii=False) + '\n'
+      return
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(keys)
+    for row in rows:
+      writer.writerow(row)
+      if buf.tell() >= FLUSH_BYTES:
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+  finally:
+    db.close()
+
+
+def export_response(open_session, stmt, name: str, fmt: str):
+  if fmt not in MEDIA_TYPES:
+    raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+  return StreamingResponse(
+      stream_rows(open_session, stmt, fmt),
+      media_type=MEDIA_TYPES[fmt],
+      headers={'Content-Disposition': f'attachment; filename="{name}.{fmt}"'},
+  )
+
+
+@router.get("/api/arrival/export")
+def export_arrival(format: str = 'csv',
+                   supplier_id: Union[int, None] = None,
+                   invoce_number: Union[str, None] = None,
+                   info: Union[str, None] = None,
+                   from_date: Union[dt_date, None] = None,
+                   to_date: Union[dt_date, None] = None,
+                   manufacturer: Union[str, None] = None,
+                   unit_id: Union[int, None] = None,
+                   from_purchase_price: Union[float, None] = None,
+                   to_purchase_price: Union[float, None] = None,
+                   from_retail_price: Union[float, None] = None,
+                   to_retail_price: Union[float, None] = None,
+                   product_id: Union[int, None] = None,
+                   status: Union[int, None] = None,
+                   user: md.User = Depends(deps.auth_middleware),
+                   sessions=Depends(read_sessions)):
+  q = select(
+      md.Arrival.id, md.Arrival.date, md.Arrival.invoce_number,
+      md.Arrival.supplier_id, md.Supplier.name.label('supplier_name'),
+      md.Arrival.product_id, md.Product.name.label('product_name'),
+      md.Arrival.manufacturer, md.Arrival.count,
+      md.Arrival.unit_id, md.Unit.name.label('unit_name'),
+      md.Arrival.purchase_price, md.Arrival.retail_price,
+      md.Arrival.info, md.Arrival.status, md.Arrival.user_id,
+  ).outerjoin(md.Arrival.supplier).outerjoin(md.Arrival.product) \
+      .outerjoin(md.Arrival.unit).order_by(md.Arrival.id)
+  q = filters.arrival(
+      q, supplier_id=supplier_id, invoce_number=invoce_number, info=info,
+      from_date=from_date, to_date=to_date, manufacturer=manufacturer,
+      unit_id=unit_id, from_purchase_price=from_purchase_price,
+      to_purchase_price=to_purchase_price, from_retail_price=from_retail_price,
+      to_retail_price=to_retail_price, product_id=product_id, status=status)
+  return export_response(sessions, q, 'arrivals', format)
+
+
+@router.get("/api/sale/export")
+def export_sale(format: str = 'csv',
+                from_date: Union[dt_date, None] = None,
+                to_date: Union[dt_date, None] = None,
+                car_vin: Union[str, None] = None,
+                car_number: Union[str, None] = None,
+                master_id: Union[int, None] = None,
+                service: Union[str, None] = None,
+                product_id: Union[int, None] = None,
+                user_id: Union[int, None] = None,
+                from_price: Union[float, None] = None,
+                to_price: Union[float, None] = None,
+                car_model: Union[str, None] = None,
+                user=Depends(deps.auth_middleware), sessions=Depends(read_sessions)):
+  q = select(
+      md.Sale.id, md.Sale.date, md.Sale.car_model, md.Sale.car_vin,
+      md.Sale.car_number, md.Sale.master_id, md.Master.name.label('master_name'),
+      md.Sale.service, md.Sale.price, md.Sale.user_id,
+      md.User.login.label('user_login'),
+  ).outerjoin(md.Sale.master).outerjoin(md.Sale.user).order_by(md.Sale.id)
+  q = filters.sale(
+      q, from_date=from_date, to_date=to_date, car_vin=car_vin,
+      car_number=car_number, master_id=master_id, service=service,
+      product_id=product_id, user_id=user_id, from_price=from_price,
+      to_price=to_price, car_model=car_model)
+  return export_response(sessions, q, 'sales', format)
+
+
+@router.get("/api/sale/lines/export")
+def export_sale_lines(format: str = 'csv',
+                      from_date: Union[dt_date, None] = None,
+                      to_date: Union[dt_date, None] = None,
+                      master_id: Union[int, None] = None,
+                      product_id: Union[int, None] = None,
+                      user_id: Union[int, None] = None,
+                      user=Depends(deps.auth_middleware), sessions=Depends(read_sessions)):
+  """One row per sale line, with its own count and price."""
+  link = md.sale_product_relationship
+  q = select(
+      link.c.sale_id, md.Sale.date, link.c.stock_id, md.Stock.product_id,
+      md.Product.name.label('product_name'),
+      func.coalesce(link.c.count, 1).label('count'),
+      func.coalesce(link.c.price, md.Stock.price).label('price'),
+  ).select_from(link) \
+      .join(md.Sale, md.Sale.id == link.c.sale_id) \
+      .join(md.Stock, md.Stock.id == link.c.stock_id) \
+      .outerjoin(md.Stock.product) \
+      .order_by(link.c.sale_id, link.c.stock_id)
+  q = filters.sale(q, from_date=from_date, to_date=to_date, master_id=master_id,
+                   user_id=user_id)
+  if product_id is not None:
+    # the lines of that product, not every line of the sales holding it
+    q = q.where(md.Stock.product_id == product_id)
+  return export_response(sessions, q, 'sale_lines', format)
+
+
+@router.get("/api/product_return/export")
+def export_product_return(format: str = 'csv',
+                          from_date: Union[dt_date, None] = None,
+                          to_date: Union[dt_date, None] = None,
+                          from_price: Union[float, None] = None,
+                          to_price: Union[float, None] = None,
+                          supplier_id: Union[int, None] = None,
+                          product_id: Union[int, None] = None,
+                          status: Union[int, None] = None,
+                          user: md.User = Depends(deps.auth_middleware), sessions=Depends(read_sessions)):
+  q = select(
+      md.ProductReturn.id, md.ProductReturn.date, md.ProductReturn.invoce_number,
+      md.ProductReturn.supplier_id, md.Supplier.name.label('supplier_name'),
+      md.ProductReturn.product_id, md.Product.name.label('product_name'),
+      md.ProductReturn.count, md.ProductReturn.price,
+      md.ProductReturn.status, md.ProductReturn.user_id,
+  ).outerjoin(md.ProductReturn.supplier).outerjoin(md.ProductReturn.product) \
+      .order_by(md.ProductReturn.id)
+  q = filters.product_return(
+      q, from_date=from_date, to_date=to_date, from_price=from_price,
+      to_price=to_price, supplier_id=supplier_id, product_id=product_id,
+      status=status)
+  return export_response(sessions, q, 'product_returns', format)
+
+
+@router.get("/api/disposal/export")
+def export_disposal(format: str = 'csv',
+                    from_date: Union[dt_date, None] = None,
+                    to_date: Union[dt_date, None] = None,
+                    product_id: Union[int, None] = None,
+                    cause: Union[str, None] = None,
+                    user: md.User = Depends(deps.auth_middleware), sessions=Depends(read_sessions)):
+  q = select(
+      md.Disposal.id, md.Disposal.date,
+      md.Disposal.product_id, md.Product.name.label('product_name'),
+      md.Disposal.count, md.Disposal.cause, md.Disposal.user_id,
+  ).outerjoin(md.Disposal.product).order_by(md.Disposal.id)
+  q = filters.disposal(q, from_date=from_date, to_date=to_date,
+                       product_id=product_id, cause=cause)
+  return export_response(sessions, q, 'disposals', format)
@@ -0,0 +1,81 @@
+"""FIFO cost layers and the replay of stock movements, no database access.
+
+cogs feeds the movements of each changed product to replay() and stores
+what comes out; kept apart from the ORM so the costing rules can be
+tested on their own (tests/test_fifo.py).
+
+Movements are (date, kind, doc_id, product_id, count, price) tuples in
+(date, kind, doc_id) order per product. Arrivals open a layer at their
+purchase price; sale lines, spent supplier returns and disposals take
+from the oldest layers first. Quantity taken beyond the open layers is
+costed at the last known cost of the product and reported as uncosted.
+"""
+from collections import deque
+from typing import Dict, Iterable, Tuple
+
+ARRIVAL, SALE, PRODUCT_RETURN, DISPOSAL = range(4)
+EPS = 1e-9
+
+
+class Ledger:
+  """FIFO layers per product: deque of [count, unit cost], oldest first."""
+
+  def __init__(self):
+    self.layers: Dict[int, deque] = {}
+    self.last_cost: Dict[int, float] = {}
+
+  def add(self, product_id: int, count: float, cost: float):
+    self.last_cost[product_id] = cost
+    if count > EPS:
+      self.layers.setdefault(product_id, deque()).append([count, cost])
+
+  def take(self, product_id: int, count: float):
+    """Cost of `count` units and the part of it not covered by any layer."""
+    layers = self.layers.get(product_id)
+    cost = 0.0
+    while count > EPS and layers:
+      layer = layers[0]
+      n = min(layer[0], count)
+      cost += n * layer[1]
+      layer[0] -= n
+      count -= n
+      if layer[0] <= EPS:
+        layers.popleft()
+    if count <= EPS:
+      return cost, 0.0
+    return cost + count * self.last_cost.get(product_id, 0.0), count
+
+  def rows(self, product_id: int):
+    layers = self.layers.get(product_id)
+    if layers:
+      return [{'product_id': product_id, 'seq': i, 'count': count, 'cost': cost}
+              for i, (count, cost) in enumerate(layers)]
+    if product_id in self.last_cost:
+      return [{'product_id': product_id, 'seq': 0, 'count': 0, 'cost': self.last_cost[product_id]}]
+    return []
+
+
+def replay(movements: Iterable[tuple]) -> Tuple[Ledger, Dict[tuple, dict]]:
+  """The ledger after `movements` and the cost of every sale line.
+
+  Sale lines are keyed and grouped by (sale_id, product_id), so two stock
+  lots of one product on a sale give one entry.
+  """
+  ledger = Ledger()
+  lines = {}
+  for day, kind, doc_id, product_id, count, price in movements:
+    if kind == ARRIVAL:
+      ledger.add(product_id, count, price)
+      continue
+    cost, uncosted = ledger.take(product_id, count)
+    if kind != SALE:
+      continue
+    line = lines.get((doc_id, product_id))
+    if line is None:
+      line = lines[doc_id, product_id] = {'sale_id': doc_id, 'product_id': product_id,
+                                          'date': day, 'revenue': 0.0, 'cogs': 0.0,
+                                          'uncosted': 0.0}
+    line['revenue'] += count * price
+    line['cogs'] += cost
+    line['uncosted'] += uncosted
+  return ledger, lines
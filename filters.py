@@ -0,0 +1,155 @@
+"""Filters of the list endpoints, shared by the sync, async and export paths.
+
+Every list has a FilterSet: query parameters (Filter) plus conditions
+that always apply. A Filter builds its condition from a value, which is
+either the request's value (apply, for ad-hoc queries) or a bindparam
+(resources, which compile each filter combination once). None, and for
+most filters empty or 0, means the filter is not used.
+"""
+from datetime import date as dt_date
+
+from sqlalchemy import bindparam
+
+import models as md
+from search import escape_like, name_search
+
+
+class Filter:
+  def __init__(self, name: str, type_, clause, like: bool = False, allow_zero: bool = False):
+    self.name = name
+    self.type_ = type_
+    self.clause = clause
+    self.like = like
+    self.allow_zero = allow_zero
+
+  def active(self, value) -> bool:
+    return value is not None and (self.allow_zero or bool(value))
+
+  def param(self, value):
+    """Value as it is bound into the clause."""
+    return f'%{escape_like(value)}%' if self.like else value
+
+  def bound(self):
+    return self.clause(bindparam(self.name))
+
+
+def eq(name, column, type_=int, allow_zero=False):
+  return Filter(name, type_, lambda v: column == v, allow_zero=allow_zero)
+
+
+def ge(name, column, type_=float):
+  return Filter(name, type_, lambda v: column >= v, allow_zero=True)
+
+
+def le(name, column, type_=float):
+  return Filter(name, type_, lambda v: column <= v, allow_zero=True)
+
+
+def like(name, column):
+  """Substring filter, served by the column's trigram index on postgres."""
+  return Filter(name, str, lambda v: column.ilike(v, escape='\\'), like=True)
+
+
+def dates(column):
+  return [ge('from_date', column, dt_date), le('to_date', column, dt_date)]
+
+
+class FilterSet:
+  def __init__(self, *filters, where=()):
+    self.filters = {f.name: f for f in filters}
+    self.where = list(where)
+
+  def apply(self, q, **values):
+    unknown = set(values) - self.filters.keys()
+    if unknown:
+      raise TypeError(f'unknown filters: {", ".join(sorted(unknown))}')
+    for clause in self.where:
+      q = q.filter(clause)
+    for name, value in values.items():
+      f = self.filters[name]
+      if f.active(value):
+        q = q.filter(f.clause(f.param(value)))
+    return q
+
+
+ARRIVAL = FilterSet(
+    *dates(md.Arrival.date),
+    like('invoce_number', md.Arrival.invoce_number),
+    like('manufacturer', md.Arrival.manufacturer),
+    like('info', md.Arrival.info),
+    eq('supplier_id', md.Arrival.supplier_id),
+    eq('status', md.Arrival.status, allow_zero=True),
+    eq('unit_id', md.Arrival.unit_id),
+    eq('product_id', md.Arrival.product_id),
+    ge('from_purchase_price', md.Arrival.purchase_price),
+    le('to_purchase_price', md.Arrival.purchase_price),
+    ge('from_retail_price', md.Arrival.retail_price),
+    le('to_retail_price', md.Arrival.retail_price),
+)
+
+SALE = FilterSet(
+    *dates(md.Sale.date),
+    like('car_vin', md.Sale.car_vin),
+    like('service', md.Sale.service),
+    like('car_model', md.Sale.car_model),
+    like('car_number', md.Sale.car_number),
+    eq('master_id', md.Sale.master_id),
+    Filter('product_id', int, lambda v: md.Sale.stock.any(md.Stock.product_id == v)),
+    eq('user_id', md.Sale.user_id),
+    ge('from_price', md.Sale.price),
+    le('to_price', md.Sale.price),
+)
+
+PRODUCT_RETURN = FilterSet(
+    *dates(md.ProductReturn.date),
+    ge('from_price', md.ProductReturn.price),
+    le('to_price', md.ProductReturn.price),
+    eq('supplier_id', md.ProductReturn.supplier_id),
+    eq('product_id', md.ProductReturn.product_id),
+    eq('status', md.ProductReturn.status, allow_zero=True),
+)
+
+DISPOSAL = FilterSet(
+    *dates(md.Disposal.date),
+    eq('product_id', md.Disposal.product_id),
+    like('cause', md.Disposal.cause),
+)
+
+INVENTORY = FilterSet(
+    *dates(md.Inventory.date),
+    like('inventory_cause', md.Inventory.inventory_cause),
+    like('info', md.Inventory.info),
+)
+
+STOCK = FilterSet(
+    eq('supplier_id', md.Stock.supplier_id),
+    eq('product_id', md.Stock.product_id),
+    Filter('product_name', str, lambda v: md.Stock.product.has(md.Product.name.ilike(v, escape='\\')),
+           like=True),
+    Filter('supplier_name', str, lambda v: md.Stock.supplier.has(md.Supplier.name.ilike(v, escape='\\')),
+           like=True),
+    where=[md.Stock.count > 0],
+)
+
+
+def between(q, column, lo=None, hi=None):
+  if lo is not None:
+    q = q.filter(column >= lo)
+  if hi is not None:
+    q = q.filter(column <= hi)
+  return q
+
+
+arrival = ARRIVAL.apply
+sale = SALE.apply
+product_return = PRODUCT_RETURN.apply
+disposal = DISPOSAL.apply
+inventory = INVENTORY.apply
+stock = STOCK.apply
+
+
+def by_name(q, sql_model, name: str = ''):
+  """Name lookup on a reference table, ranked by search when `name` is given."""
+  if name:
+    return name_search(q, sql_model.name, name, sql_model.id)
+  return q.order_by(sql_model.name)
@@ -0,0 +1,211 @@
+"""Idempotency-Key support for the document POST endpoints.
+
+A POST to one of PATHS with an Idempotency-Key header runs once per
+(user, path, key) across all workers and hosts. The first request claims
+the key with an INSERT ... ON CONFLICT into md.IdempotencyKey; its
+response is stored in that row and replayed to retries with an
+Idempotent-Replayed header. A duplicate that arrives while the first
+request is still running polls the row for up to IDEMPOTENCY_WAIT
+seconds and then gets 409. Reusing a key with a different body is
+rejected with 422; 5xx responses are not stored and the claim is
+deleted, so those requests can be retried.
+
+The user is the user_id of the verified access token, so a refreshed
+token keeps its keys; requests without a valid token are passed through
+untouched and get their 401 from the endpoint. Keys expire after
+IDEMPOTENCY_TTL seconds. A claim that is still unfinished after
+IDEMPOTENCY_CLAIM_TIMEOUT seconds, e.g. its worker died, is taken over
+by the next retry.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from datetime import timedelta
+from typing import Union
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.dialects import postgresql
+
+import deps
+import models as md
+from auth import JWT_SECRET_KEY
+from db_conn import engine
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+# how long a duplicate waits for the request that is already running
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 30))
+IDEMPOTENCY_CLAIM_TIMEOUT = int(os.environ.get('IDEMPOTENCY_CLAIM_TIMEOUT', 300))
+POLL_INTERVAL = 0.2
+# share of the claims that also delete the expired keys
+PURGE_SAMPLE = 0.01
+MAX_KEY_LENGTH = 255
+
+PATHS = {
+    '/api/sale',
+    '/api/arrival',
+    '/api/product_return',
+    '/api/product_return/spend',
+}
+
+Key = md.IdempotencyKey
+
+_counters = {'claimed': 0, 'replayed': 0, 'conflicts': 0, 'timeouts': 0}
+
+
+def stats() -> dict:
+  return dict(_counters)
+
+
+def _where(ids: tuple):
+  user_id, path, key = ids
+  return and_(Key.user_id == user_id, Key.path == path, Key.key == key)
+
+
+def _older_than(seconds: int):
+  return Key.created < func.now() - timedelta(seconds=seconds)
+
+
+def claim(ids: tuple, fingerprint: str):
+  """(True, None) if this request now owns the key, else (False, the stored row).
+
+  The row is None if its request failed and released the key meanwhile.
+  """
+  user_id, path, key = ids
+  stmt = postgresql.insert(Key).values(user_id=user_id, path=path, key=key,
+                                       fingerprint=fingerprint)
+  stmt = stmt.on_conflict_do_update(
+      index_elements=[Key.user_id, Key.path, Key.key],
+      set_={'fingerprint': stmt.excluded.fingerprint, 'status': None, 'headers': None,
+            'body': None, 'created': func.now()},
+      # an expired key, or a claim whose request never finished
+      where=or_(_older_than(IDEMPOTENCY_TTL),
+                and_(Key.status.is_(None), _older_than(IDEMPOTENCY_CLAIM_TIMEOUT))),
+  ).returning(Key.user_id)
+  with engine.begin() as conn:
+    if random.random() < PURGE_SAMPLE:
+      conn.execute(delete(Key).where(_older_than(IDEMPOTENCY_TTL)))
+    if conn.execute(stmt).first() is not None:
+      return True, None
+    return False, conn.execute(
+        select(Key.fingerprint, Key.status, Key.headers, Key.body).where(_where(ids))).first()
+
+
+def finish(ids: tuple, status: int, headers: list, body: bytes):
+  with engine.begin() as conn:
+    conn.execute(update(Key).where(_where(ids)).values(
+        status=status, body=body,
+        headers=[[k.decode('latin-1'), v.decode('latin-1')] for k, v in headers]))
+
+
+def release(ids: tuple):
+  with engine.begin() as conn:
+    conn.execute(delete(Key).where(_where(ids)))
+
+
+async def _send_json(send, status: int, detail: str):
+  body = json.dumps({'detail': detail}).encode()
+  await send({'type': 'http.response.start', 'status': status,
+              'headers': [(b'content-type', b'application/json'),
+                          (b'content-length', str(len(body)).encode())]})
+  await send({'type': 'http.response.body', 'body': body})
+
+
+async def _replay(send, stored):
+  headers = [(k.encode('latin-1'), v.encode('latin-1')) for k, v in stored.headers]
+  await send({'type': 'http.response.start', 'status': stored.status,
+              'headers': headers + [(b'idempotent-replayed', b'true')]})
+  await send({'type': 'http.response.body', 'body': stored.body})
+
+
+def _user_id(headers: dict) -> Union[int, None]:
+  scheme, _, token = headers.get(b'authorization', b'').decode('latin-1').partition(' ')
+  if scheme.lower() != 'bearer' or not token:
+    return None
+  try:
+    return deps.verify_token(token, JWT_SECRET_KEY, 'access').user_id
+  except HTTPException:
+    return None
+
+
+class IdempotencyMiddleware:
+  def __init__(self, app, paths=PATHS):
+    self.app = app
+    self.paths = paths
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in self.paths:
+      return await self.app(scope, receive, send)
+    headers = dict(scope['headers'])
+    key = headers.get(b'idempotency-key')
+    if not key:
+      return await self.app(scope, receive, send)
+    if len(key) > MAX_KEY_LENGTH:
+      return await _send_json(send, 400, 'Idempotency-Key is too long')
+    user_id = _user_id(headers)
+    if user_id is None:
+      return await self.app(scope, receive, send)
+
+    chunks = []
+    while True:
+      message = await receive()
+      if message['type'] == 'http.disconnect':
+        return
+      chunks.append(message.get('body', b''))
+      if not message.get('more_body'):
+        break
+    body = b''.join(chunks)
+    fingerprint = hashlib.sha256(scope['query_string'] + b'\0' + body).hexdigest()
+    ids = (user_id, scope['path'], key.decode('latin-1'))
+
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    while True:
+      claimed, stored = await run_in_threadpool(claim, ids, fingerprint)
+      if claimed:
+        break
+      if stored is None:
+        continue
+      if stored.fingerprint != fingerprint:
+        _counters['conflicts'] += 1
+        return await _send_json(send, 422, 'Idempotency-Key was used with a different request')
+      if stored.status is not None:
+        _counters['replayed'] += 1
+        return await _replay(send, stored)
+      if time.monotonic() > deadline:
+        _counters['timeouts'] += 1
+        return await _send_json(send, 409, 'a request with this Idempotency-Key is in progress')
+      await asyncio.sleep(POLL_INTERVAL)
+    _counters['claimed'] += 1
+
+    response = {'status': 500, 'headers': [], 'body': []}
+    sent_body = False
+
+    async def replay_receive():
+      nonlocal sent_body
+      if not sent_body:
+        sent_body = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+      return await receive()
+
+    async def capture_send(message):
+      if message['type'] == 'http.response.start':
+        response['status'] = message['status']
+        response['headers'] = list(message.get('headers', []))
+      elif message['type'] == 'http.response.body':
+        response['body'].append(message.get('body', b''))
+      await send(message)
+
+    stored = False
+    try:
+      await self.app(scope, replay_receive, capture_send)
+      data = b''.join(response['body'])
+      if response['status'] < 500:
+        await run_in_threadpool(finish, ids, response['status'], response['headers'], data)
+        stored = True
+    finally:
+      if not stored:
+        await run_in_threadpool(release, ids)
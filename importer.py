@@ -0,0 +1,224 @@
+"""Bulk CSV import of products, suppliers and opening stock.
+
+The upload is parsed as a stream and handled CHUNK rows at a time: rows
+are validated, references are checked with one IN query per column and
+the valid rows are loaded with COPY (postgres) or a bulk INSERT, each
+chunk inside its own savepoint. Invalid rows are skipped and reported
+by line number instead of failing the whole file. When the database
+rejects a chunk, it is retried row by row, each row in its own
+savepoint, so the report names the offending lines and the other rows
+of the chunk are still imported. A file that is not UTF-8 or not
+parseable CSV is rejected as a whole with 400.
+
+Opening stock is upserted on (product_id, supplier_id, price), like
+arrivals, so re-importing a lot adds to its count.
+"""
+import csv
+import io
+from typing import Dict, List
+
+from fastapi import APIRouter, Depends, File, UploadFile
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel, ValidationError, confloat, constr
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import deps
+import models as md
+from db_conn import get_db
+
+router = APIRouter()
+
+CHUNK = 5000
+MAX_ERRORS = 1000
+
+
+class ProductRow(BaseModel):
+  name: constr(strip_whitespace=True, min_length=1)
+
+
+class SupplierRow(BaseModel):
+  name: constr(strip_whitespace=True, min_length=1)
+
+
+class StockRow(BaseModel):
+  product_id: int
+  supplier_id: int
+  unit_id: int
+  count: confloat(ge=0)
+  price: confloat(ge=0)
+
+
+# entity -> (model, row schema, {column: referenced model})
+ENTITIES = {
+    'product': (md.Product, ProductRow, {}),
+    'supplier': (md.Supplier, SupplierRow, {}),
+    'stock': (md.Stock, StockRow, {
+        'product_id': md.Product,
+        'supplier_id': md.Supplier,
+        'unit_id': md.Unit,
+    }),
+}
+
+
+class Report:
+  def __init__(self):
+    self.rows = 0
+    self.imported = 0
+    self.failed = 0
+    self.errors = []
+
+  def error(self, line: int, errors: List[str]):
+    self.failed += 1
+    if len(self.errors) < MAX_ERRORS:
+      self.errors.append({'line': line, 'errors': errors})
+
+  def dict(self) -> dict:
+    return {
+        'rows': self.rows,
+        'imported': self.imported,
+        'failed': self.failed,
+        'errors': self.errors,
+        'errors_truncated': self.failed > len(self.errors),
+    }
+
+
+def validate(chunk: List[tuple], schema, report: Report) -> List[tuple]:
+  """Keep the (line, row) pairs that pass `schema`, with parsed values."""
+  valid = []
+  for line, row in chunk:
+    try:
+      valid.append((line, schema(**row).dict()))
+    except ValidationError as e:
+      report.error(line, [f'{".".join(map(str, x["loc"]))}: {x["msg"]}' for x in e.errors()])
+  return valid
+
+
+def check_references(db: Session, rows: List[tuple], references: Dict[str, md.Base], report: Report) -> List[tuple]:
+  missing = {}
+  for column, model in references.items():
+    ids = {values[column] for _, values in rows}
+    found = {x for (x,) in db.query(model.id).filter(model.id.in_(ids))}
+    missing[column] = ids - found
+  valid = []
+  for line, values in rows:
+    errors = [f'{column}: {values[column]} does not exist'
+              for column, ids in missing.items() if values[column] in ids]
+    if errors:
+      report.error(line, errors)
+    else:
+      valid.append((line, values))
+  return valid
+
+
+def copy_rows(db: Session, table, rows: List[dict]):
+  columns = list(rows[0])
+  if db.bind.dialect.name != 'postgresql':
+    db.execute(insert(table), rows)
+    return
+  buf = io.StringIO()
+  writer = csv.writer(buf)
+  for row in rows:
+    writer.writerow([row[c] for c in columns])
+  buf.seek(0)
+  cursor = db.connection().connection.cursor()
+  cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buf)
+
+
+def upsert_stock(db: Session, rows: List[dict]):
+  # ON CONFLICT can not touch the same row twice, so merge lines per stock key first
+  merged = {}
+  for row in rows:
+    key = (row['product_id'], row['supplier_id'], row['price'])
+    if key in merged:
+      merged[key]['count'] += row['count']
+    else:
+      merged[key] = dict(row)
+  stmt = postgresql.insert(md.Stock).values(list(merged.values()))
+  stmt = stmt.on_conflict_do_update(
+      constraint="uq_stock_product_supplier_price",
+      set_={'count': md.Stock.count + stmt.excluded.count},
+  )
+  db.execute(stmt)
+
+
+def _write(db: Session, entity: str, values: List[dict]):
+  with db.begin_nested():
+    if entity == 'stock':
+      upsert_stock(db, values)
+    else:
+      copy_rows(db, ENTITIES[entity][0].__table__, values)
+
+
+def _message(e: Exception) -> str:
+  return str(getattr(e, 'orig', e)).strip()
+
+
+def load(db: Session, entity: str, rows: List[tuple], user_id: int, report: Report):
+  values = [v for _, v in rows]
+  if entity != 'stock':
+    for v in values:
+      v['user_id'] = user_id
+  try:
+    _write(db, entity, values)
+  except Exception:
+    # one bad row fails the whole chunk, find it
+    for line, v in rows:
+      try:
+        _write(db, entity, [v])
+      except Exception as e:
+        report.error(line, [_message(e)])
+      else:
+        report.imported += 1
+    return
+  report.imported += len(rows)
+
+
+def decoded_lines(file):
+  """Lines of the upload as text, 400 naming the first line that is not UTF-8."""
+  # decoded per line rather than through a TextIOWrapper, whose read-ahead
+  # buffer hides where the bad bytes are; b'\n' never occurs inside a
+  # multi-byte UTF-8 sequence
+  for number, raw in enumerate(file, start=1):
+    try:
+      yield raw.decode('utf-8-sig' if number == 1 else 'utf-8')
+    except UnicodeDecodeError:
+      raise HTTPException(status_code=400, detail=f"line {number} is not UTF-8 encoded")
+
+
+def read_chunks(file, columns):
+  reader = csv.DictReader(decoded_lines(file))
+  try:
+    missing = set(columns) - set(reader.fieldnames or [])
+    if missing:
+      raise HTTPException(status_code=400, detail=f"missing columns: {', '.join(sorted(missing))}")
+    chunk = []
+    for row in reader:
+      # line of the row in the file, header is line 1
+      chunk.append((reader.line_num, {k: v for k, v in row.items() if k in columns and v != ''}))
+      if len(chunk) >= CHUNK:
+        yield chunk
+        chunk = []
+    if chunk:
+      yield chunk
+  except csv.Error as e:
+    raise HTTPException(status_code=400, detail=f"line {reader.line_num}: {e}")
+
+
+@router.post("/api/import/{entity}")
+def import_csv(entity: str, file: UploadFile = File(...),
+               user: md.User = Depends(deps.auth_middleware), db: Session = Depends(get_db)):
+  if entity not in ENTITIES:
+    raise HTTPException(status_code=404, detail=f"can not import {entity}")
+  model, schema, references = ENTITIES[entity]
+  report = Report()
+  for chunk in read_chunks(file.file, list(schema.__fields__)):
+    report.rows += len(chunk)
+    rows = validate(chunk, schema, report)
+    if rows and references:
+      rows = check_references(db, rows, references, report)
+    if rows:
+      load(db, entity, rows, user.id, report)
+  db.commit()
+  return report.dict()
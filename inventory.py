@@ -0,0 +1,146 @@
+"""Inventory counts: counted quantities per stock row and reconciliation.
+
+While an inventory is open (status 0) counted quantities are submitted
+in batches and upserted into md.InventoryLine, a later count of the
+same stock row replaces the earlier one. Closing the inventory, in one
+transaction, locks the counted stock rows, snapshots Stock.count into
+InventoryLine.expected and sets Stock.count to the counted quantity,
+all with set-based statements. Stock rows that were not counted are
+left alone.
+"""
+from typing import List
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.exceptions import HTTPException
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import deps
+import models as md
+from db_conn import get_db
+from pagination import MAX_PAGE_SIZE, CursorPage
+
+router = APIRouter()
+
+BATCH = 5000
+
+line = md.InventoryLine
+
+
+def open_inventory(db: Session, inventory_id: int):
+  """Check that the inventory exists and is open, and hold it open until commit."""
+  status = db.query(md.Inventory.status).filter(md.Inventory.id == inventory_id) \
+      .with_for_update(read=True).scalar()
+  if status is None:
+    raise HTTPException(status_code=404, detail="Inventory not found")
+  if status != 0:
+    raise HTTPException(status_code=400, detail="inventory is closed")
+
+
+def submit(db: Session, inventory_id: int, counts: List[md.PydanticInventoryCount]) -> int:
+  open_inventory(db, inventory_id)
+  counted = {x.stock_id: x.counted for x in counts}
+  found = {x for (x,) in db.query(md.Stock.id).filter(md.Stock.id.in_(list(counted)))}
+  missing = sorted(set(counted) - found)
+  if missing:
+    db.rollback()
+    raise HTTPException(status_code=404, detail=f"Stock items not found: {missing}")
+  rows = [{'inventory_id': inventory_id, 'stock_id': k, 'counted': v} for k, v in counted.items()]
+  for i in range(0, len(rows), BATCH):
+    stmt = postgresql.insert(line).values(rows[i:i + BATCH])
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_inventory_line",
+        set_={'counted': stmt.excluded.counted},
+    )
+    db.execute(stmt)
+  db.commit()
+  return len(rows)
+
+
+def summary(db: Session, inventory_id: int) -> dict:
+  expected = func.coalesce(line.expected, md.Stock.count)
+  difference = line.counted - expected
+  row = db.execute(
+      select(func.count().label('lines'),
+             func.count().filter(difference != 0).label('changed'),
+             func.coalesce(func.sum(difference), 0).label('difference'),
+             func.coalesce(func.sum(difference * md.Stock.price), 0).label('value'))
+      .join(md.Stock, md.Stock.id == line.stock_id)
+      .where(line.inventory_id == inventory_id)).one()
+  return dict(row._mapping)
+
+
+def close(db: Session, inventory_id: int) -> dict:
+  closed = db.execute(
+      update(md.Inventory)
+      .where(md.Inventory.id == inventory_id, md.Inventory.status == 0)
+      .values(status=1)
+      .returning(md.Inventory.id)
+      .execution_options(synchronize_session=False)
+  ).scalar()
+  if closed is None:
+    db.rollback()
+    if db.query(md.Inventory.id).filter(md.Inventory.id == inventory_id).first() is None:
+      raise HTTPException(status_code=404, detail="Inventory not found")
+    raise HTTPException(status_code=400, detail="inventory is closed")
+  # FOR UPDATE in the subquery keeps sales from changing the counted rows
+  # between the snapshot and the adjustment
+  locked = select(md.Stock.id, md.Stock.count) \
+      .join(line, line.stock_id == md.Stock.id) \
+      .where(line.inventory_id == inventory_id) \
+      .with_for_update(of=md.Stock).subquery()
+  db.execute(
+      update(line)
+      .where(line.inventory_id == inventory_id, line.stock_id == locked.c.id)
+      .values(expected=locked.c.count)
+      .execution_options(synchronize_session=False))
+  db.execute(
+      update(md.Stock)
+      .where(md.Stock.id == line.stock_id,
+             line.inventory_id == inventory_id,
+             line.counted != line.expected)
+      .values(count=line.counted)
+      .execution_options(synchronize_session=False))
+  result = summary(db, inventory_id)
+  db.commit()
+  return result
+
+
+@router.post("/api/inventory/{item_id}/lines")
+def add_inventory_lines(item_id: int, items: List[md.PydanticInventoryCount],
+                        user: md.User = Depends(deps.auth_middleware), db: Session = Depends(get_db)):
+  return {'inventory_id': item_id, 'lines': submit(db, item_id, items)}
+
+
+@router.get("/api/inventory/{item_id}/lines")
+def get_inventory_lines(item_id: int, page_size: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+                        cursor: str = '',
+                        with_count: bool = False, only_changed: bool = False,
+                        user: md.User = Depends(deps.auth_middleware), db: Session = Depends(get_db)):
+  """Counted lines with their difference, against the current stock until closed."""
+  expected = func.coalesce(line.expected, md.Stock.count)
+  q = db.query(line.id, line.stock_id, md.Stock.product_id,
+               md.Product.name.label('product_name'), md.Stock.supplier_id,
+               md.Stock.price, line.counted, expected.label('expected'),
+               (line.counted - expected).label('difference')) \
+      .join(md.Stock, md.Stock.id == line.stock_id) \
+      .join(md.Product, md.Product.id == md.Stock.product_id) \
+      .filter(line.inventory_id == item_id)
+  if only_changed:
+    q = q.filter(line.counted != expected)
+  try:
+    p = CursorPage(q, [(line.id, False)], cursor, page_size, with_count)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  return {
+      'items': [dict(row._mapping) for row in p.items],
+      'next_cursor': p.next_cursor,
+      'item_count': p.item_count,
+      'summary': summary(db, item_id),
+  }
+
+
+@router.post("/api/inventory/{item_id}/close")
+def close_inventory(item_id: int, user: md.User = Depends(deps.auth_middleware), db: Session = Depends(get_db)):
+  return {'inventory_id': item_id, **close(db, item_id)}
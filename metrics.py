@@ -0,0 +1,204 @@
+"""Per-request SQL instrumentation and Prometheus metrics.
+
+Engine events count the queries, SQL time and rows of the request that
+is being served (tracked through a context variable). The same SELECT
+repeated N_PLUS_ONE_THRESHOLD times within one request, typically a
+lazy load such as Stock.product or Sale.master inside a loop, is
+reported as an N+1 pattern. Everything is exposed in Prometheus text
+format at /api/_metrics, to the clients in METRICS_ALLOW only (comma
+separated addresses or networks, localhost by default). Behind a proxy
+that is the address the proxy connects from, unless uvicorn runs with
+--forwarded-allow-ips.
+"""
+import ipaddress
+import logging
+import os
+import time
+from contextvars import ContextVar
+from threading import Lock
+
+from fastapi import FastAPI, Request
+from fastapi.exceptions import HTTPException
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('metrics')
+
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+METRICS_ALLOW = [ipaddress.ip_network(x.strip(), strict=False) for x in
+                 os.environ.get('METRICS_ALLOW', '127.0.0.1,::1').split(',') if x.strip()]
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RequestStats:
+  __slots__ = ('scope', 'route', 'queries', 'sql_time', 'rows', 'shapes')
+
+  def __init__(self, scope: dict = None):
+    self.scope = scope
+    self.route = None
+    self.queries = 0
+    self.sql_time = 0.0
+    self.rows = 0
+    self.shapes = {}
+
+  def route_name(self) -> str:
+    """'GET /api/sale' style name of the route being served."""
+    if self.scope is None:
+      return ''
+    route = self.scope.get('route')
+    path = route.path if route is not None else self.scope.get('path', '')
+    return f'{self.scope.get("method", "")} {path}'
+
+
+current: ContextVar = ContextVar('request_stats', default=None)
+
+_lock = Lock()
+_routes = {}
+_pools = {}
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  # on the execution context, not the connection: a statement that fails
+  # never reaches after_cursor_execute and must not leave anything behind
+  if context is not None:
+    context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  stats: RequestStats = current.get()
+  if stats is None or context is None:
+    return
+  elapsed = time.perf_counter() - context._metrics_started
+  stats.queries += 1
+  stats.sql_time += elapsed
+  stats.rows += max(cursor.rowcount, 0)
+  if statement.lstrip()[:6].upper() == 'SELECT':
+    stats.shapes[statement] = stats.shapes.get(statement, 0) + 1
+
+
+def _route_metrics(key: tuple) -> dict:
+  metrics = _routes.get(key)
+  if metrics is None:
+    metrics = _routes[key] = {
+        'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0,
+        'queries': 0, 'sql_time': 0.0, 'rows': 0, 'n_plus_one': 0,
+    }
+  return metrics
+
+
+def _record(method: str, route: str, elapsed: float, stats: RequestStats):
+  repeated = [(s, n) for s, n in stats.shapes.items() if n >= N_PLUS_ONE_THRESHOLD]
+  for statement, n in repeated:
+    logger.warning('N+1 on %s %s: %d x %s', method, route, n, ' '.join(statement.split())[:200])
+  with _lock:
+    metrics = _route_metrics((method, route))
+    for i, le in enumerate(BUCKETS):
+      if elapsed <= le:
+        metrics['buckets'][i] += 1
+    metrics['count'] += 1
+    metrics['sum'] += elapsed
+    metrics['queries'] += stats.queries
+    metrics['sql_time'] += stats.sql_time
+    metrics['rows'] += stats.rows
+    metrics['n_plus_one'] += len(repeated)
+
+
+def _watch_pool(name: str, engine: Engine):
+  pool = engine.pool
+  stats = _pools[name] = {'pool': pool, 'checkouts': 0, 'wait': 0.0, 'wait_max': 0.0}
+  connect = pool.connect
+
+  def timed_connect(*args, **kwargs):
+    started = time.perf_counter()
+    try:
+      return connect(*args, **kwargs)
+    finally:
+      waited = time.perf_counter() - started
+      with _lock:
+        stats['checkouts'] += 1
+        stats['wait'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+
+  pool.connect = timed_connect
+
+
+def render() -> str:
+  lines = [
+      '# HELP http_request_duration_seconds Request latency per route.',
+      '# TYPE http_request_duration_seconds histogram',
+  ]
+  with _lock:
+    routes = sorted(_routes.items())
+    for (method, route), m in routes:
+      labels = f'method="{method}",route="{route}"'
+      for le, n in zip(BUCKETS, m['buckets']):
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{le}"}} {n}')
+      lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {m["count"]}')
+      lines.append(f'http_request_duration_seconds_sum{{{labels}}} {m["sum"]}')
+      lines.append(f'http_request_duration_seconds_count{{{labels}}} {m["count"]}')
+    for name, key, kind, help_text in (
+        ('db_queries_total', 'queries', 'counter', 'SQL statements executed.'),
+        ('db_query_seconds_total', 'sql_time', 'counter', 'Time spent in SQL.'),
+        ('db_rows_total', 'rows', 'counter', 'Rows returned or affected.'),
+        ('db_n_plus_one_total', 'n_plus_one', 'counter', 'Requests flagged with repeated SELECTs.')):
+      lines.append(f'# HELP {name} {help_text}')
+      lines.append(f'# TYPE {name} {kind}')
+      for (method, route), m in routes:
+        lines.append(f'{name}{{method="{method}",route="{route}"}} {m[key]}')
+    for name, help_text, kind, value in (
+        ('db_pool_size', 'Configured pool size.', 'gauge', lambda s: s['pool'].size()),
+        ('db_pool_checked_out', 'Connections in use.', 'gauge', lambda s: s['pool'].checkedout()),
+        ('db_pool_overflow', 'Connections over pool_size.', 'gauge', lambda s: s['pool'].overflow()),
+        ('db_pool_checkouts_total', 'Connection checkouts.', 'counter', lambda s: s['checkouts']),
+        ('db_pool_wait_seconds_total', 'Time waited for a connection.', 'counter', lambda s: s['wait']),
+        ('db_pool_wait_seconds_max', 'Longest wait for a connection.', 'gauge', lambda s: s['wait_max'])):
+      lines.append(f'# HELP {name} {help_text}')
+      lines.append(f'# TYPE {name} {kind}')
+      for pool_name, s in sorted(_pools.items()):
+        try:
+          lines.append(f'{name}{{pool="{pool_name}"}} {value(s)}')
+        except AttributeError:
+          # pools without size/overflow, e.g. NullPool
+          pass
+  return '\n'.join(lines) + '\n'
+
+
+def allowed(request: Request) -> bool:
+  if request.client is None:
+    return False
+  try:
+    address = ipaddress.ip_address(request.client.host)
+  except ValueError:
+    return False
+  return any(address in network for network in METRICS_ALLOW)
+
+
+def install(app: FastAPI, engines: dict):
+  for name, engine in engines.items():
+    _watch_pool(name, engine)
+
+  @app.middleware('http')
+  async def sql_metrics(request: Request, call_next):
+    stats = RequestStats(request.scope)
+    token = current.set(stats)
+    started = time.perf_counter()
+    try:
+      response = await call_next(request)
+    finally:
+      current.reset(token)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get('route')
+    stats.route = route.path if route is not None else 'unmatched'
+    _record(request.method, stats.route, elapsed, stats)
+    response.headers['Server-Timing'] = \
+        f'db;dur={stats.sql_time * 1000:.1f};desc="{stats.queries} queries", total;dur={elapsed * 1000:.1f}'
+    return response
+
+  @app.get('/api/_metrics', include_in_schema=False)
+  def get_metrics(request: Request):
+    if not allowed(request):
+      raise HTTPException(status_code=403, detail="metrics are not available to this client")
+    return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,88 @@
+"""Schema setup, run once per deploy before the workers start:
+
+  python -m migrate           apply what is missing
+  python -m migrate status    list applied and pending migrations
+
+A run first creates the tables that do not exist yet (create_all, which
+never alters an existing table), then applies the scripts in
+migrations/ that are not recorded in schema_migrations, in file name
+order, each in its own transaction together with its record. Changes
+to existing tables (new columns, constraints, indexes, triggers) go in
+a new NNNN_name.sql script. Scripts have to be idempotent: on a new
+database create_all already made the tables in their current shape.
+Concurrent runs wait for each other on an advisory lock.
+
+Request workers no longer touch the schema on startup; set
+AUTO_CREATE_SCHEMA=1 to get the old create-on-startup behaviour, e.g.
+for a local development database.
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+
+import models  # registers the tables on Base.metadata
+import search  # creates pg_trgm ahead of the trigram indexes
+from db_conn import Base, engine
+
+AUTO_CREATE_SCHEMA = os.environ.get('AUTO_CREATE_SCHEMA', '0') == '1'
+
+MIGRATIONS = Path(__file__).parent / 'migrations'
+LOCK_ID = 7_202_415
+
+VERSION_TABLE = text(
+    "CREATE TABLE IF NOT EXISTS schema_migrations ("
+    " version text PRIMARY KEY,"
+    " applied_at timestamptz NOT NULL DEFAULT now())")
+
+
+def scripts() -> list:
+  return sorted(MIGRATIONS.glob('[0-9]*.sql'))
+
+
+def applied(conn) -> set:
+  conn.execute(VERSION_TABLE)
+  return set(conn.execute(text('SELECT version FROM schema_migrations')).scalars())
+
+
+def migrate() -> list:
+  """Apply the pending migrations, returns their versions."""
+  done = []
+  with engine.begin() as conn:
+    # held until the end of this transaction; the scripts below wait on
+    # the same lock, so a concurrent run blocks until this one is through
+    conn.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': LOCK_ID})
+    Base.metadata.create_all(conn)
+    have = applied(conn)
+  for path in scripts():
+    if path.stem in have:
+      continue
+    with engine.begin() as conn:
+      conn.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': LOCK_ID})
+      if path.stem in applied(conn):
+        continue
+      conn.exec_driver_sql(path.read_text())
+      conn.execute(text('INSERT INTO schema_migrations (version) VALUES (:v)'), {'v': path.stem})
+    done.append(path.stem)
+  return done
+
+
+def status() -> list:
+  with engine.begin() as conn:
+    have = applied(conn)
+  return [(path.stem, path.stem in have) for path in scripts()]
+
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['status']:
+    for version, is_applied in status():
+      print(f'{"applied" if is_applied else "pending"}  {version}')
+    sys.exit()
+  if sys.argv[1:]:
+    sys.exit('usage: python -m migrate [status]')
+  started = time.perf_counter()
+  done = migrate()
+  print(f'applied {", ".join(done) or "nothing"}, '
+        f'schema is up to date ({time.perf_counter() - started:.1f} s)')
@@ -0,0 +1,32 @@
+-- user-005: one stock row per (product_id, supplier_id, price), the key of
+-- the arrival upsert. Rows that already share a key are merged into the
+-- lowest id first; rows with a NULL key column are left alone, the same
+-- as the constraint does.
+CREATE TEMP TABLE stock_dupes ON COMMIT DROP AS
+SELECT id, keep_id, count
+FROM (
+  SELECT id, count, min(id) OVER (PARTITION BY product_id, supplier_id, price) AS keep_id
+  FROM stock
+  WHERE product_id IS NOT NULL AND supplier_id IS NOT NULL AND price IS NOT NULL
+) s
+WHERE id <> keep_id;
+
+UPDATE stock s SET count = s.count + d.total
+FROM (SELECT keep_id, sum(count) AS total FROM stock_dupes GROUP BY keep_id) d
+WHERE s.id = d.keep_id;
+
+INSERT INTO sale_product_relationship (sale_id, stock_id)
+SELECT DISTINCT l.sale_id, d.keep_id
+FROM sale_product_relationship l JOIN stock_dupes d ON d.id = l.stock_id
+ON CONFLICT DO NOTHING;
+
+DELETE FROM sale_product_relationship l USING stock_dupes d WHERE l.stock_id = d.id;
+DELETE FROM stock s USING stock_dupes d WHERE s.id = d.id;
+
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_stock_product_supplier_price') THEN
+    ALTER TABLE stock ADD CONSTRAINT uq_stock_product_supplier_price
+      UNIQUE (product_id, supplier_id, price);
+  END IF;
+END $$;
@@ -0,0 +1,6 @@
+-- user-006: trigram indexes behind the ?name= search of the reference tables
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS ix_products_name_trgm ON products USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_suppliers_name_trgm ON suppliers USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_units_name_trgm ON units USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_masters_name_trgm ON masters USING gin (name gin_trgm_ops);
@@ -0,0 +1,27 @@
+-- user-010: version rows of the reference tables, bumped by a statement
+-- trigger in the writer's transaction (refcache_versions itself comes
+-- from create_all)
+CREATE OR REPLACE FUNCTION refcache_bump() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO refcache_versions (name, version, modified) VALUES (TG_TABLE_NAME, 1, now())
+  ON CONFLICT (name) DO UPDATE
+  SET version = refcache_versions.version + 1, modified = now();
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+INSERT INTO refcache_versions (name, version, modified)
+VALUES ('products', 1, now()), ('suppliers', 1, now()), ('units', 1, now()), ('masters', 1, now())
+ON CONFLICT (name) DO NOTHING;
+
+DROP TRIGGER IF EXISTS products_refcache ON products;
+CREATE TRIGGER products_refcache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+  ON products FOR EACH STATEMENT EXECUTE FUNCTION refcache_bump();
+DROP TRIGGER IF EXISTS suppliers_refcache ON suppliers;
+CREATE TRIGGER suppliers_refcache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+  ON suppliers FOR EACH STATEMENT EXECUTE FUNCTION refcache_bump();
+DROP TRIGGER IF EXISTS units_refcache ON units;
+CREATE TRIGGER units_refcache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+  ON units FOR EACH STATEMENT EXECUTE FUNCTION refcache_bump();
+DROP TRIGGER IF EXISTS masters_refcache ON masters;
+CREATE TRIGGER masters_refcache AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+  ON masters FOR EACH STATEMENT EXECUTE FUNCTION refcache_bump();
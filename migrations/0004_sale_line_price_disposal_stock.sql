@@ -0,0 +1,8 @@
+-- user-011: count and price per sale line, and the stock row a disposal
+-- was taken from. Lines written before keep NULL, read as one unit at the
+-- stock price (see cogs.movements).
+ALTER TABLE sale_product_relationship
+  ADD COLUMN IF NOT EXISTS count double precision,
+  ADD COLUMN IF NOT EXISTS price double precision;
+ALTER TABLE disposals
+  ADD COLUMN IF NOT EXISTS stock_id integer REFERENCES stock (id);
@@ -0,0 +1,134 @@
+-- user-020: cogs.update replays the whole history of every product whose
+-- movements changed, so inserts, PUTs, deletes, backdated documents and
+-- transactions that commit late are all picked up. Statement triggers
+-- write the product ids to cost_changes (from create_all) in the
+-- writer's transaction; cogs.update deletes the rows it replays.
+--
+-- Sale costs are kept per (sale, product) so one product can be replayed
+-- on its own. The cost tables are derived, they are emptied here and
+-- every product is queued for the next update.
+DROP TABLE IF EXISTS cost_checkpoints;
+TRUNCATE sale_costs, cost_layers;
+ALTER TABLE sale_costs
+  ADD COLUMN IF NOT EXISTS product_id integer NOT NULL REFERENCES products (id);
+ALTER TABLE sale_costs DROP CONSTRAINT IF EXISTS sale_costs_pkey;
+ALTER TABLE sale_costs ADD PRIMARY KEY (sale_id, product_id);
+CREATE INDEX IF NOT EXISTS ix_sale_costs_product_id ON sale_costs (product_id);
+INSERT INTO cost_changes (product_id) SELECT id FROM products;
+
+-- documents with a product_id column
+CREATE OR REPLACE FUNCTION cost_changes_product() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP <> 'DELETE' THEN
+    INSERT INTO cost_changes (product_id)
+    SELECT DISTINCT product_id FROM new_rows WHERE product_id IS NOT NULL;
+  END IF;
+  IF TG_OP <> 'INSERT' THEN
+    INSERT INTO cost_changes (product_id)
+    SELECT DISTINCT product_id FROM old_rows WHERE product_id IS NOT NULL;
+  END IF;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- sale lines, the product is the one of the stock lot
+CREATE OR REPLACE FUNCTION cost_changes_line() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP <> 'DELETE' THEN
+    INSERT INTO cost_changes (product_id)
+    SELECT DISTINCT s.product_id FROM new_rows n JOIN stock s ON s.id = n.stock_id;
+  END IF;
+  IF TG_OP <> 'INSERT' THEN
+    INSERT INTO cost_changes (product_id)
+    SELECT DISTINCT s.product_id FROM old_rows o JOIN stock s ON s.id = o.stock_id;
+  END IF;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- a new sale date moves its lines in the replay order
+CREATE OR REPLACE FUNCTION cost_changes_sale() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO cost_changes (product_id)
+  SELECT DISTINCT s.product_id
+  FROM new_rows n
+  JOIN old_rows o ON o.id = n.id
+  JOIN sale_product_relationship l ON l.sale_id = n.id
+  JOIN stock s ON s.id = l.stock_id
+  WHERE o.date IS DISTINCT FROM n.date;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- lines without a price are valued at the stock price; stock counts
+-- change on every sale and are left out
+CREATE OR REPLACE FUNCTION cost_changes_stock() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO cost_changes (product_id)
+  SELECT DISTINCT x.product_id
+  FROM new_rows n
+  JOIN old_rows o ON o.id = n.id
+  CROSS JOIN LATERAL (VALUES (n.product_id), (o.product_id)) x (product_id)
+  WHERE o.product_id IS DISTINCT FROM n.product_id OR o.price IS DISTINCT FROM n.price;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS arrivals_cost_insert ON arrivals;
+CREATE TRIGGER arrivals_cost_insert AFTER INSERT ON arrivals
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+DROP TRIGGER IF EXISTS arrivals_cost_update ON arrivals;
+CREATE TRIGGER arrivals_cost_update AFTER UPDATE ON arrivals
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+DROP TRIGGER IF EXISTS arrivals_cost_delete ON arrivals;
+CREATE TRIGGER arrivals_cost_delete AFTER DELETE ON arrivals
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+
+DROP TRIGGER IF EXISTS product_returns_cost_insert ON product_returns;
+CREATE TRIGGER product_returns_cost_insert AFTER INSERT ON product_returns
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+DROP TRIGGER IF EXISTS product_returns_cost_update ON product_returns;
+CREATE TRIGGER product_returns_cost_update AFTER UPDATE ON product_returns
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+DROP TRIGGER IF EXISTS product_returns_cost_delete ON product_returns;
+CREATE TRIGGER product_returns_cost_delete AFTER DELETE ON product_returns
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+
+DROP TRIGGER IF EXISTS disposals_cost_insert ON disposals;
+CREATE TRIGGER disposals_cost_insert AFTER INSERT ON disposals
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+DROP TRIGGER IF EXISTS disposals_cost_update ON disposals;
+CREATE TRIGGER disposals_cost_update AFTER UPDATE ON disposals
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+DROP TRIGGER IF EXISTS disposals_cost_delete ON disposals;
+CREATE TRIGGER disposals_cost_delete AFTER DELETE ON disposals
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_product();
+
+DROP TRIGGER IF EXISTS sale_product_relationship_cost_insert ON sale_product_relationship;
+CREATE TRIGGER sale_product_relationship_cost_insert AFTER INSERT ON sale_product_relationship
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_line();
+DROP TRIGGER IF EXISTS sale_product_relationship_cost_update ON sale_product_relationship;
+CREATE TRIGGER sale_product_relationship_cost_update AFTER UPDATE ON sale_product_relationship
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_line();
+DROP TRIGGER IF EXISTS sale_product_relationship_cost_delete ON sale_product_relationship;
+CREATE TRIGGER sale_product_relationship_cost_delete AFTER DELETE ON sale_product_relationship
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_line();
+
+DROP TRIGGER IF EXISTS sales_cost_update ON sales;
+CREATE TRIGGER sales_cost_update AFTER UPDATE ON sales
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_sale();
+
+DROP TRIGGER IF EXISTS stock_cost_update ON stock;
+CREATE TRIGGER stock_cost_update AFTER UPDATE ON stock
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION cost_changes_stock();
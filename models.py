@@ -1,12 +1,10 @@
-from email.policy import default
-from enum import unique
-from xmlrpc.client import Boolean
 from sqlalchemy import func
 from db_conn import Base
 
 from sqlalchemy.orm import relationship
 from sqlalchemy import Column, Integer, String, ForeignKey, \
-    Float, CheckConstraint,  Date, UniqueConstraint, ARRAY, Table, Boolean
+    Float, CheckConstraint,  Date, UniqueConstraint, ARRAY, Table, Boolean, Index, \
+    BigInteger, DateTime, JSON, LargeBinary
 from pydantic_sqlalchemy import sqlalchemy_to_pydantic
 from pydantic import BaseModel, Field
 from typing import Union, List
@@ -39,11 +37,17 @@ sale_product_relationship = Table(
     Base.metadata,
     Column("sale_id", ForeignKey("sales.id"), primary_key=True),
     Column("stock_id", ForeignKey("stock.id"), primary_key=True),
+    Column("count", Float),
+    Column("price", Float),
 )
 
 
 class Supplier(Base):
   __tablename__ = "suppliers"
+  __table_args__ = (
+      Index("ix_suppliers_name_trgm", "name", postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"}),
+  )
   id = Column(Integer, primary_key=True, index=True)
   name = Column(String)
   arrival = relationship("Arrival", back_populates="supplier")
@@ -55,6 +59,10 @@ class Supplier(Base):
 
 class Unit(Base):
   __tablename__ = "units"
+  __table_args__ = (
+      Index("ix_units_name_trgm", "name", postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"}),
+  )
   id = Column(Integer, primary_key=True, index=True)
   name = Column(String)
   arrival = relationship("Arrival", back_populates="unit")
@@ -65,6 +73,10 @@ class Unit(Base):
 
 class Master(Base):
   __tablename__ = "masters"
+  __table_args__ = (
+      Index("ix_masters_name_trgm", "name", postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"}),
+  )
   id = Column(Integer, primary_key=True, index=True)
   name = Column(String)
   amount = Column(Float, CheckConstraint("amount >=0"), nullable=False, default=0)
@@ -120,6 +132,10 @@ class Sale(Base):
 
 class Product(Base):
   __tablename__ = "products"
+  __table_args__ = (
+      Index("ix_products_name_trgm", "name", postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"}),
+  )
   id = Column(Integer, primary_key=True, index=True)
   name = Column(String)
   user_id = Column(Integer, ForeignKey("users.id"), nullable=False, default=1)
@@ -156,6 +172,7 @@ class Disposal(Base):
   product = relationship("Product", back_populates="disposal")
   count = Column(Float, CheckConstraint("count >=0"), nullable=False)
   cause = Column(String, nullable=False)
+  stock_id = Column(Integer, ForeignKey("stock.id"))
   user_id = Column(Integer, ForeignKey("users.id"), nullable=False, default=1)
   user = relationship("User", back_populates="disposal")
 
@@ -170,10 +187,29 @@ class Inventory(Base):
   user = relationship("User", back_populates="inventory")
   status = Column(Integer, CheckConstraint(
       "status in (0,1)"), default=0, nullable=False)
+  lines = relationship("InventoryLine", back_populates="inventory")
+
+
+class InventoryLine(Base):
+  __tablename__ = "inventory_lines"
+  __table_args__ = (
+      UniqueConstraint("inventory_id", "stock_id", name="uq_inventory_line"),
+  )
+  id = Column(Integer, primary_key=True, index=True)
+  inventory_id = Column(Integer, ForeignKey("inventoryes.id"), nullable=False)
+  inventory = relationship("Inventory", back_populates="lines")
+  stock_id = Column(Integer, ForeignKey("stock.id"), nullable=False)
+  counted = Column(Float, CheckConstraint("counted >=0"), nullable=False)
+  # Stock.count at the moment the inventory was closed
+  expected = Column(Float)
 
 
 class Stock(Base):
   __tablename__ = "stock"
+  __table_args__ = (
+      UniqueConstraint("product_id", "supplier_id", "price",
+                       name="uq_stock_product_supplier_price"),
+  )
   id = Column(Integer, primary_key=True, index=True)
   product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
   product = relationship(Product, back_populates="stock")
@@ -188,6 +224,76 @@ class Stock(Base):
   )
 
 
+class SaleRollup(Base):
+  __tablename__ = "sale_rollups"
+  __table_args__ = (
+      UniqueConstraint("date", "dimension", "key_id", name="uq_sale_rollup"),
+  )
+  id = Column(Integer, primary_key=True, index=True)
+  date = Column(Date, nullable=False)
+  dimension = Column(String(10), CheckConstraint(
+      "dimension in ('master','user','product')"), nullable=False)
+  # masters.id / users.id / products.id, 0 for sales without a master
+  key_id = Column(Integer, nullable=False)
+  revenue = Column(Float, nullable=False, default=0)
+  count = Column(Float, nullable=False, default=0)
+  stock_value = Column(Float, nullable=False, default=0)
+
+
+# products whose movements changed since the last cogs.update, filled by
+# the triggers of migrations/0005_cost_changes.sql; one row per write,
+# duplicates included
+cost_changes = Table(
+    "cost_changes",
+    Base.metadata,
+    Column("product_id", Integer, nullable=False),
+)
+
+
+class CostLayer(Base):
+  """Open FIFO layers per product; a layer with count 0 only keeps the last cost."""
+  __tablename__ = "cost_layers"
+  id = Column(Integer, primary_key=True, index=True)
+  product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
+  seq = Column(Integer, nullable=False)
+  count = Column(Float, nullable=False)
+  cost = Column(Float, nullable=False)
+
+
+class SaleCost(Base):
+  """Revenue and COGS of the lines of a sale, per product."""
+  __tablename__ = "sale_costs"
+  sale_id = Column(Integer, ForeignKey("sales.id"), primary_key=True)
+  product_id = Column(Integer, ForeignKey("products.id"), primary_key=True, index=True)
+  date = Column(Date, nullable=False, index=True)
+  revenue = Column(Float, nullable=False, default=0)
+  cogs = Column(Float, nullable=False, default=0)
+  # quantity sold without a cost layer, costed at the last known cost
+  uncosted = Column(Float, nullable=False, default=0)
+
+
+class IdempotencyKey(Base):
+  """Claimed Idempotency-Key of a POST and, once it finished, its response."""
+  __tablename__ = "idempotency_keys"
+  user_id = Column(Integer, primary_key=True)
+  path = Column(String, primary_key=True)
+  key = Column(String(255), primary_key=True)
+  fingerprint = Column(String(64), nullable=False)
+  # NULL while the first request is still running
+  status = Column(Integer)
+  headers = Column(JSON)
+  body = Column(LargeBinary)
+  created = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+
+
+class RefcacheVersion(Base):
+  """Write version of a reference table, bumped by the trigger in refcache."""
+  __tablename__ = "refcache_versions"
+  name = Column(String, primary_key=True)
+  version = Column(BigInteger, nullable=False)
+  modified = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
 class PydanticArrivalList(BaseModel):
   manufacturer: str
   product_id: int
@@ -210,6 +316,11 @@ class PydanticArrivalAdd(BaseModel):
   items: List[PydanticArrivalList]
 
 
+class PydanticInventoryCount(BaseModel):
+  stock_id: int
+  counted: float = Field(..., ge=0)
+
+
 class TokenPayload(BaseModel):
   exp: int
   user_id: int
@@ -222,24 +333,45 @@ class UserAuth(BaseModel):
                         description="user password")
 
 
-PydanticProduct = sqlalchemy_to_pydantic(Product, exclude=['user_id'])
-PydanticSupplier = sqlalchemy_to_pydantic(Supplier, exclude=['user_id'])
-PydanticUnit = sqlalchemy_to_pydantic(Unit, exclude=['user_id'])
-PydanticMaster = sqlalchemy_to_pydantic(Master, exclude=['user_id'])
-PydanticArrival = sqlalchemy_to_pydantic(Arrival, exclude=['user_id'])
-PydanticSale = sqlalchemy_to_pydantic(Sale, exclude=['user_id'])
-PydanticProductReturn = sqlalchemy_to_pydantic(
-    ProductReturn, exclude=['user_id'])
-PydanticDisposal = sqlalchemy_to_pydantic(Disposal, exclude=['user_id'])
-PydanticInventory = sqlalchemy_to_pydantic(Inventory, exclude=['user_id'])
-PydanticUser = sqlalchemy_to_pydantic(User)
-PydanticStock = sqlalchemy_to_pydantic(Stock)
-
-class StockList(PydanticSale):
-  id : int
-  count: float
-  price: float
-
-
-class PydanticSaleAdd(PydanticSale):
-  products_id: List[StockList]
+def _stock_list():
+  class StockList(__getattr__('PydanticSale')):
+    id : int
+    count: float
+    price: float
+  return StockList
+
+
+def _sale_add():
+  class PydanticSaleAdd(__getattr__('PydanticSale')):
+    products_id: List[__getattr__('StockList')]
+  return PydanticSaleAdd
+
+
+# built on first access by the module __getattr__. Only the processes that
+# need the tables alone (migrate, python -m rollup / cogs, bench.seed) skip
+# the generation; a web worker still builds every model while importing
+# main, since the route signatures of resources.REGISTRY, async_routes and
+# the handlers in main need them at registration
+_PYDANTIC_MODELS = {
+    'PydanticProduct': lambda: sqlalchemy_to_pydantic(Product, exclude=['user_id']),
+    'PydanticSupplier': lambda: sqlalchemy_to_pydantic(Supplier, exclude=['user_id']),
+    'PydanticUnit': lambda: sqlalchemy_to_pydantic(Unit, exclude=['user_id']),
+    'PydanticMaster': lambda: sqlalchemy_to_pydantic(Master, exclude=['user_id']),
+    'PydanticArrival': lambda: sqlalchemy_to_pydantic(Arrival, exclude=['user_id']),
+    'PydanticSale': lambda: sqlalchemy_to_pydantic(Sale, exclude=['user_id']),
+    'PydanticProductReturn': lambda: sqlalchemy_to_pydantic(ProductReturn, exclude=['user_id']),
+    'PydanticDisposal': lambda: sqlalchemy_to_pydantic(Disposal, exclude=['user_id']),
+    'PydanticInventory': lambda: sqlalchemy_to_pydantic(Inventory, exclude=['user_id']),
+    'PydanticUser': lambda: sqlalchemy_to_pydantic(User),
+    'PydanticStock': lambda: sqlalchemy_to_pydantic(Stock),
+    'StockList': _stock_list,
+    'PydanticSaleAdd': _sale_add,
+}
+
+
+def __getattr__(name: str):
+  factory = _PYDANTIC_MODELS.get(name)
+  if factory is None:
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+  model = globals()[name] = factory()
+  return model
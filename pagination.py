@@ -0,0 +1,145 @@
+import base64
+import json
+import os
+from datetime import date, datetime
+from typing import List, Tuple
+
+from sqlalchemy import and_, bindparam, false, or_
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.orm import Query
+
+# upper bound of ?page_size= on every list endpoint
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+
+def encode_cursor(values: list) -> str:
+  raw = json.dumps(values, default=str, separators=(',', ':')).encode()
+  return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> list:
+  try:
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    values = json.loads(raw)
+  except ValueError:
+    raise ValueError('invalid cursor')
+  if not isinstance(values, list):
+    raise ValueError('invalid cursor')
+  return values
+
+
+def _nullable(column) -> bool:
+  return getattr(column.expression, 'nullable', True)
+
+
+def _after(column, descending: bool, value):
+  step = column < value if descending else column > value
+  if not _nullable(column):
+    return step
+  # NULLs sort last in both directions (keyset_order)
+  if isinstance(value, BindParameter):
+    return or_(step, and_(column.is_(None), value.is_not(None)))
+  if value is None:
+    return false()
+  return or_(step, column.is_(None))
+
+
+def _seek(keys, values):
+  # (k1, k2, ...) > (v1, v2, ...) spelled out so that every key may have
+  # its own direction; `values` may be bindparams
+  clauses = []
+  for i, (column, descending) in enumerate(keys):
+    equal = [c.is_not_distinct_from(v) if _nullable(c) else c == v
+             for (c, _), v in zip(keys[:i], values[:i])]
+    clauses.append(and_(*equal, _after(column, descending, values[i])))
+  return or_(*clauses)
+
+
+def keyset_order(keys) -> list:
+  order = []
+  for c, d in keys:
+    o = c.desc() if d else c.asc()
+    order.append(o.nulls_last() if _nullable(c) else o)
+  return order
+
+
+def _python_type(column):
+  try:
+    return column.type.python_type
+  except NotImplementedError:
+    return None
+
+
+def _cursor_value(column, value):
+  """`value` decoded for `column`, ValueError if it does not fit."""
+  if value is None:
+    if not _nullable(column):
+      raise ValueError('invalid cursor')
+    return None
+  kind = _python_type(column)
+  if kind is bool or kind is None:
+    return value
+  if kind is int:
+    ok = isinstance(value, int) and not isinstance(value, bool)
+  elif kind is float:
+    ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+  elif kind in (date, datetime):
+    ok = isinstance(value, str)
+    if ok:
+      try:
+        value = kind.fromisoformat(value)
+      except ValueError:
+        ok = False
+  else:
+    ok = isinstance(value, kind)
+  if not ok:
+    raise ValueError('invalid cursor')
+  return value
+
+
+def cursor_values(keys, cursor: str) -> list:
+  """Decoded and type checked values of a cursor for `keys`."""
+  values = decode_cursor(cursor)
+  if len(values) != len(keys):
+    raise ValueError('invalid cursor')
+  return [_cursor_value(c, v) for (c, _), v in zip(keys, values)]
+
+
+def keyset_filter(keys, cursor: str):
+  return _seek(keys, cursor_values(keys, cursor))
+
+
+def keyset_bound(keys):
+  """keyset_filter with bindparams key0, key1, ... for prebuilt statements."""
+  return _seek(keys, [bindparam(f'key{i}', type_=c.type) for i, (c, _) in enumerate(keys)])
+
+
+def keyset_params(keys, cursor: str) -> dict:
+  return {f'key{i}': v for i, v in enumerate(cursor_values(keys, cursor))}
+
+
+def next_cursor(keys, last) -> str:
+  return encode_cursor([getattr(last, c.key) for c, _ in keys])
+
+
+class CursorPage:
+  """Keyset page over `query` ordered by `keys`, a list of (column, descending).
+
+  The last key has to be unique (normally the primary key) so the
+  position between pages is unambiguous.
+  """
+
+  def __init__(self, query: Query, keys: List[Tuple], cursor: str = '',
+               items_per_page: int = 10, with_count: bool = False):
+    if not 1 <= items_per_page <= MAX_PAGE_SIZE:
+      raise ValueError(f'page size must be between 1 and {MAX_PAGE_SIZE}')
+    self.items_per_page = items_per_page
+    self.item_count = query.order_by(None).count() if with_count else None
+    q = query.order_by(None).order_by(*keyset_order(keys))
+    if cursor:
+      q = q.filter(keyset_filter(keys, cursor))
+    rows = q.limit(items_per_page + 1).all()
+    self.items = rows[:items_per_page]
+    self.next_cursor = None
+    if len(rows) > items_per_page:
+      self.next_cursor = next_cursor(keys, self.items[-1])
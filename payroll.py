@@ -0,0 +1,105 @@
+"""Master payroll for a period: Master.amount plus Master.percentage of their sales.
+
+Sales are loaded as two columns into NumPy arrays and aggregated by
+master_id with bincount. On psycopg2 the columns come from a binary
+COPY read with np.frombuffer, so no row objects are built at all.
+"""
+import io
+from datetime import date as dt_date
+from typing import List
+
+import numpy as np
+from fastapi import APIRouter, Depends
+from sqlalchemy import Float, Integer, cast, func, select
+from sqlalchemy.orm import Session
+
+import deps
+import filters
+import models as md
+from db_routing import get_read_db
+
+router = APIRouter()
+
+# a binary COPY row of (int4 master_id, float8 price), big-endian
+COPY_ROW = np.dtype([('fields', '>i2'), ('master_id_len', '>i4'), ('master_id', '>i4'),
+                     ('price_len', '>i4'), ('price', '>f8')])
+
+
+def sales_stmt(from_date: dt_date = None, to_date: dt_date = None):
+  # fixed int4 / float8 columns, the layout _copy_sales reads
+  return filters.between(
+      select(cast(md.Sale.master_id, Integer), cast(func.coalesce(md.Sale.price, 0), Float(53)))
+      .where(md.Sale.master_id.isnot(None)),
+      md.Sale.date, from_date, to_date)
+
+
+def _copy_sales(conn, stmt):
+  """COPY ... (FORMAT binary) of the two columns, read into NumPy without row objects."""
+  compiled = stmt.compile(dialect=conn.dialect)
+  buf = io.BytesIO()
+  cur = conn.connection.cursor()
+  try:
+    sql = cur.mogrify(str(compiled), compiled.params).decode()
+    cur.copy_expert(f'COPY ({sql}) TO STDOUT (FORMAT binary)', buf)
+  finally:
+    cur.close()
+  data = buf.getbuffer()
+  # 11 byte signature, int32 flags, int32 extension length, extension
+  offset = 19 + int.from_bytes(data[15:19], 'big')
+  # every row is 22 bytes, the stream ends with an int16 -1 trailer
+  rows = np.frombuffer(data, dtype=COPY_ROW, offset=offset,
+                       count=(len(data) - offset - 2) // COPY_ROW.itemsize)
+  return rows['master_id'].astype(np.int64), rows['price'].astype(np.float64)
+
+
+def load_sales(db: Session, from_date: dt_date = None, to_date: dt_date = None):
+  stmt = sales_stmt(from_date, to_date)
+  conn = db.connection()
+  if conn.dialect.driver == 'psycopg2':
+    return _copy_sales(conn, stmt)
+  # plain DBAPI tuples straight into a preallocated array
+  rows = conn.execute(stmt).cursor.fetchall()
+  data = np.empty((len(rows), 2), dtype=np.float64)
+  if rows:
+    data[:] = rows
+  return data[:, 0].astype(np.int64), data[:, 1]
+
+
+def aggregate(master_ids: np.ndarray, prices: np.ndarray, size: int):
+  """Per-master (sales count, revenue) arrays indexed by master id."""
+  counts = np.bincount(master_ids, minlength=size)
+  revenue = np.bincount(master_ids, weights=prices, minlength=size)
+  return counts, revenue
+
+
+def compute(db: Session, from_date: dt_date = None, to_date: dt_date = None) -> List[dict]:
+  masters = db.query(md.Master.id, md.Master.name,
+                     md.Master.amount, md.Master.percentage) \
+      .order_by(md.Master.id).all()
+  if not masters:
+    return []
+  master_ids, prices = load_sales(db, from_date, to_date)
+  size = max(masters[-1].id, int(master_ids.max(initial=0))) + 1
+  counts, revenue = aggregate(master_ids, prices, size)
+  ids = np.fromiter((m.id for m in masters), dtype=np.int64, count=len(masters))
+  amount = np.fromiter((m.amount for m in masters), dtype=np.float64, count=len(masters))
+  percentage = np.fromiter((m.percentage for m in masters), dtype=np.float64, count=len(masters))
+  commission = revenue[ids] * percentage / 100
+  payout = amount + commission
+  return [{
+      'master_id': m.id,
+      'name': m.name,
+      'sales_count': int(counts[m.id]),
+      'revenue': float(revenue[m.id]),
+      'amount': m.amount,
+      'percentage': m.percentage,
+      'commission': float(commission[i]),
+      'payout': float(payout[i]),
+  } for i, m in enumerate(masters)]
+
+
+@router.get("/api/master/payroll")
+def get_master_payroll(from_date: dt_date = None, to_date: dt_date = None,
+                       user: md.User = Depends(deps.auth_middleware),
+                       db: Session = Depends(get_read_db)):
+  return compute(db, from_date, to_date)
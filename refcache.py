@@ -0,0 +1,111 @@
+"""Versioned read cache with ETag revalidation for the reference tables.
+
+Every cached table has a row in refcache_versions. A statement trigger
+(migrations/0003_refcache_versions.sql) bumps that row on any INSERT,
+UPDATE, DELETE or TRUNCATE, inside the writer's transaction. This holds for any process or tool that writes:
+API workers, the importer, psql. A list request reads its table's
+version, one primary-key lookup, and then either
+
+- answers 304 if the client's ETag names the current version,
+- serves the page body this worker cached under (table, version, query),
+- or lets the handler run the list query and store() the page.
+
+Versions are shared by all workers and only grow, so an ETag or a
+cached body from before a write is never served after it commits.
+REFCACHE_TTL only bounds how long unused pages stay in memory. Writers
+to a reference table queue on its version row until they commit, which
+is fine for these rarely written tables. Without a version row, e.g.
+on a database without the trigger, nothing is cached.
+"""
+import hashlib
+import os
+from email.utils import formatdate
+from threading import Lock
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from sqlalchemy import bindparam, select
+from sqlalchemy.orm import Session
+
+import models as md
+import serializer
+from cache import TTLCache
+
+pages = TTLCache(
+    maxsize=int(os.environ.get('REFCACHE_SIZE', 2048)),
+    ttl=float(os.environ.get('REFCACHE_TTL', 60)),
+)
+
+_lock = Lock()
+_counters = {}
+
+VERSION = select(md.RefcacheVersion.version, md.RefcacheVersion.modified) \
+    .where(md.RefcacheVersion.name == bindparam('name'))
+
+
+def _table(sql_model) -> str:
+  return sql_model.__tablename__
+
+
+def _count(table: str, key: str):
+  with _lock:
+    counters = _counters.setdefault(table, {'hits': 0, 'misses': 0, 'not_modified': 0,
+                                            'uncached': 0})
+    counters[key] += 1
+
+
+def _headers(table: str, version: int, modified, query: str) -> dict:
+  digest = hashlib.sha1(query.encode()).hexdigest()[:12]
+  return {
+      'ETag': f'W/"{table}-{version}-{digest}"',
+      'Last-Modified': formatdate(modified.timestamp(), usegmt=True),
+      'Cache-Control': 'private, no-cache',
+  }
+
+
+def _not_modified(request: Request, headers: dict) -> bool:
+  # Last-Modified has one second resolution, too coarse to revalidate
+  # against, so only the ETag is checked
+  etag = request.headers.get('if-none-match')
+  if etag is None:
+    return False
+  return headers['ETag'] in [x.strip() for x in etag.split(',')]
+
+
+def lookup(request: Request, sql_model, db: Session):
+  """Response for the request if it can be served without the list query."""
+  table = _table(sql_model)
+  row = db.execute(VERSION, {'name': table}).first()
+  if row is None:
+    request.state.refcache_headers = None
+    _count(table, 'uncached')
+    return None
+  headers = _headers(table, row.version, row.modified, str(request.query_params))
+  # store() files the page under the version read before the list query,
+  # a write in between only makes the page unreachable early
+  request.state.refcache_headers = headers
+  if _not_modified(request, headers):
+    _count(table, 'not_modified')
+    return Response(status_code=304, headers=headers)
+  body = pages.get((table, headers['ETag']))
+  if body is None:
+    _count(table, 'misses')
+    return None
+  _count(table, 'hits')
+  return Response(content=body, media_type='application/json', headers=headers)
+
+
+def store(request: Request, sql_model, data) -> Response:
+  body = serializer.dumps(jsonable_encoder(data))
+  headers = getattr(request.state, 'refcache_headers', None)
+  if headers is None:
+    return Response(content=body, media_type='application/json')
+  pages.set((_table(sql_model), headers['ETag']), body)
+  return Response(content=body, media_type='application/json', headers=headers)
+
+
+def stats() -> dict:
+  with _lock:
+    tables = {table: dict(counters) for table, counters in _counters.items()}
+  return {'pages': pages.stats(), 'tables': tables}
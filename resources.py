@@ -0,0 +1,399 @@
+"""CRUD routes generated from a registry of resources.
+
+A Resource describes one table: its pydantic model, the row projection
+of its list (serializer.RowMap), the filters.FilterSet of the list, the
+keyset keys and which of the get / list / add / update routes exist.
+crud_router turns REGISTRY into routes; endpoints with their own logic
+(adding arrivals and sales, spending returns, ...) stay in main and are
+left out of the resource's ops.
+
+List statements are built once per filter signature, i.e. the filters
+present in the request, name search on/off and offset, first keyset or
+next keyset page, with a bindparam for every value. A request only
+binds its values to the cached statement, so the SQL comes out of the
+engine's compiled cache without rebuilding the query.
+"""
+import inspect
+from operator import itemgetter
+from typing import List, Union
+
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy import bindparam, func
+from sqlalchemy.orm import Session
+
+import counting
+import deps
+import filters
+import models as md
+import refcache
+import serializer
+from db_conn import Base, get_db
+from db_routing import get_read_db
+from errors import check_item_not_found, error_response, item_not_foud
+from pagination import MAX_PAGE_SIZE, keyset_bound, keyset_order, keyset_params, next_cursor
+from search import escape_like, rank
+
+GET, LIST, ADD, UPDATE = 'get', 'list', 'add', 'update'
+OPS = (GET, LIST, ADD, UPDATE)
+
+OFFSET, FIRST, SEEK = range(3)
+
+
+def get_one(item_id: int, sql_model: Base, db: Session):
+  q = db.get(sql_model, item_id)
+  return check_item_not_found(q)
+
+
+def add(pydantic_model: BaseModel, sql_model: Base, db: Session, user_id: int = 0):
+  q_data = pydantic_model.dict(exclude_unset=True)
+  try:
+    for k, v in q_data.items():
+      setattr(sql_model, k, v)
+    sql_model.id = None
+    if user_id != 0:
+      sql_model.user_id = user_id
+    db.add(sql_model)
+    db.commit()
+  except Exception as e:
+    db.rollback()
+    raise error_response(e)
+  return q_data
+
+
+def update(item: BaseModel, item_id: int, sql_model: Base, db: Session, readonly=()):
+  """`readonly`: fields left as they are, or a function of the stored row giving them."""
+  q = db.get(sql_model, item_id)
+  if q is None:
+    return JSONResponse(item_not_foud, status_code=404)
+  if callable(readonly):
+    readonly = readonly(q)
+  q_data = item.dict(exclude_unset=True, exclude=set(readonly))
+  try:
+    for k, v in q_data.items():
+      setattr(q, k, v)
+    db.add(q)
+    db.commit()
+    db.refresh(q)
+  except Exception as e:
+    db.rollback()
+    return error_response(e)
+  return q
+
+
+def search_params(name: str) -> dict:
+  term = escape_like(name)
+  return {'name': name, 'name_like': f'%{term}%', 'name_prefix': f'{term}%'}
+
+
+class Resource:
+  """One table exposed under `path`.
+
+  search: ?name= ranked search on the name column (reference tables),
+    offset pages only,
+  cached: list pages go through refcache,
+  defaults: fields forced on add,
+  readonly: fields ignored on update, or a function of the stored row
+    giving them,
+  after_list: called with (db, items) to attach data to a list page,
+  read_db: session dependency of the list.
+  """
+
+  def __init__(self, path: str, sql_model, pydantic: str, rows: serializer.RowMap = None,
+               filter_set: filters.FilterSet = None, keys: list = None, ops=OPS,
+               search: bool = False, cached: bool = False, defaults: dict = None,
+               readonly=(), after_list=None, read_db=get_read_db):
+    self.path = path
+    self.sql_model = sql_model
+    self.pydantic = pydantic
+    self.rows = rows or serializer.RowMap(sql_model)
+    self.filter_set = filter_set or filters.FilterSet()
+    self.filters = self.filter_set.filters
+    self.keys = keys or [(sql_model.id, True)]
+    self.ops = ops
+    self.search = search
+    self.cached = cached
+    self.defaults = defaults or {}
+    self.readonly = readonly
+    self.after_list = after_list
+    self.read_db = read_db
+    self.strategy = counting.strategy(self.keys)
+    self._statements = {}
+
+  def select(self, active: tuple, search: bool):
+    """The filtered, unordered list statement."""
+    stmt = self.rows.select()
+    for clause in self.filter_set.where:
+      stmt = stmt.where(clause)
+    for name in active:
+      stmt = stmt.where(self.filters[name].bound())
+    if search:
+      stmt = stmt.where(self.sql_model.name.ilike(bindparam('name_like'), escape='\\'))
+    return stmt
+
+  def statements(self, active: tuple, search: bool, mode: int):
+    """(count statement, page statement) of a filter signature, built once."""
+    key = (active, search, mode)
+    cached = self._statements.get(key)
+    if cached is not None:
+      return cached
+    base = self.select(active, search)
+    if mode == OFFSET:
+      order = rank(self.sql_model.name, bindparam('name'), bindparam('name_prefix'),
+                   self.sql_model.id) \
+          if search else keyset_order(self.keys)
+      stmt = base.order_by(*order).limit(bindparam('limit')).offset(bindparam('offset'))
+    else:
+      stmt = base if mode == FIRST else base.where(keyset_bound(self.keys))
+      stmt = stmt.order_by(*keyset_order(self.keys)).limit(bindparam('limit'))
+    # plain dict, a racing request at worst builds the same statements twice
+    self._statements[key] = base, stmt
+    return base, stmt
+
+  def page(self, db: Session, values: dict, page: int, page_size: int,
+           cursor: Union[str, None], with_count: bool, name: str = '') -> dict:
+    """Offset page by default, keyset page on `keys` once ?cursor= is passed."""
+    if page < 1 or not 1 <= page_size <= MAX_PAGE_SIZE:
+      # the route signature already rejects these, this covers direct callers
+      raise HTTPException(status_code=400,
+                          detail=f"page must be >= 1, page_size between 1 and {MAX_PAGE_SIZE}")
+    params = {k: self.filters[k].param(v) for k, v in values.items() if self.filters[k].active(v)}
+    active = tuple(sorted(params))
+    search = bool(self.search and name)
+    if search:
+      params.update(search_params(name))
+    mode = OFFSET if cursor is None else SEEK if cursor else FIRST
+    if search and mode != OFFSET:
+      # keyset pages follow (name, id), not the search ranking
+      raise HTTPException(status_code=400, detail="name search can not be paged with cursor")
+    if mode == SEEK:
+      try:
+        params.update(keyset_params(self.keys, cursor))
+      except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    base, stmt = self.statements(active, search, mode)
+
+    item_count = count_strategy = None
+    if mode == OFFSET or with_count:
+      item_count, count_strategy = counting.count(db, base, self.strategy, params)
+    if mode != OFFSET:
+      rows = db.execute(stmt, dict(params, limit=page_size + 1)).all()
+      items = rows[:page_size]
+      data = {'items': items,
+              'next_cursor': next_cursor(self.keys, items[-1]) if len(rows) > page_size else None,
+              'item_count': item_count, 'count_strategy': count_strategy}
+    else:
+      if count_strategy != counting.EXACT:
+        # an approximate total must not cut the requested page short
+        item_count = max(item_count, page * page_size)
+      page_count = (item_count - 1) // page_size + 1 if item_count else 0
+      page = max(1, min(page, page_count or 1))
+      items = db.execute(stmt, dict(params, limit=page_size, offset=(page - 1) * page_size)).all()
+      if count_strategy != counting.EXACT and len(items) < page_size and items:
+        # past the real end: the total is known exactly now
+        item_count, count_strategy = (page - 1) * page_size + len(items), counting.EXACT
+        page_count = page
+      data = {'items': items, 'page_count': page_count, 'page': page,
+              'next_page': page + 1 if page < page_count else None,
+              'item_count': item_count, 'count_strategy': count_strategy}
+    data['items'] = self.rows.to_dicts(data['items'])
+    if self.after_list is not None:
+      self.after_list(db, data['items'])
+    return data
+
+  def list_signature(self, auth=deps.auth_middleware, read_db=None,
+                     session_type=Session) -> inspect.Signature:
+    """Query parameters of the list, then the `auth` and session dependencies."""
+    kw = inspect.Parameter.KEYWORD_ONLY
+    params = [
+        inspect.Parameter('request', kw, annotation=Request),
+        inspect.Parameter('page', kw, default=Query(1, ge=1), annotation=int),
+        inspect.Parameter('page_size', kw, default=Query(10, ge=1, le=MAX_PAGE_SIZE),
+                          annotation=int),
+        inspect.Parameter('cursor', kw, default=None, annotation=Union[str, None]),
+        inspect.Parameter('with_count', kw, default=False, annotation=bool),
+    ]
+    if self.search:
+      params.append(inspect.Parameter('name', kw, default='', annotation=str))
+    params += [inspect.Parameter(f.name, kw, default=None, annotation=Union[f.type_, None])
+               for f in self.filters.values()]
+    params += [
+        inspect.Parameter('user', kw, default=Depends(auth), annotation=md.User),
+        inspect.Parameter('db', kw, default=Depends(read_db or self.read_db),
+                          annotation=session_type),
+    ]
+    return inspect.Signature(params)
+
+  def add_routes(self, router: APIRouter):
+    sql_model = self.sql_model
+    table = sql_model.__tablename__
+
+    def get_item(item_id: int, user: md.User = Depends(deps.auth_middleware),
+                 db: Session = Depends(get_db)):
+      return get_one(item_id, sql_model, db)
+
+    def get_all(request: Request, page: int, page_size: int, cursor: Union[str, None],
+                with_count: bool, user: md.User, db: Session, name: str = '', **values):
+      if self.cached:
+        cached = refcache.lookup(request, sql_model, db)
+        if cached is not None:
+          return cached
+      data = self.page(db, values, page, page_size, cursor, with_count, name)
+      if self.cached:
+        return refcache.store(request, sql_model, data)
+      return serializer.json_response(data)
+
+    # FastAPI reads the query parameters from the signature
+    get_all.__signature__ = self.list_signature()
+
+    if GET in self.ops:
+      router.add_api_route(f'{self.path}/{{item_id}}', get_item, methods=['GET'],
+                           name=f'get_{table}')
+    if LIST in self.ops:
+      router.add_api_route(self.path, get_all, methods=['GET'], name=f'list_{table}')
+    if ADD not in self.ops and UPDATE not in self.ops:
+      return
+    pydantic_model = getattr(md, self.pydantic)
+
+    def add_item(item: pydantic_model, user: md.User = Depends(deps.auth_middleware),
+                 db: Session = Depends(get_db)):
+      for k, v in self.defaults.items():
+        setattr(item, k, v)
+      return add(item, sql_model(), db, user.id)
+
+    def update_item(item: pydantic_model, item_id: int,
+                    user: md.User = Depends(deps.auth_middleware),
+                    db: Session = Depends(get_db)):
+      return update(item=item, item_id=item_id, sql_model=sql_model, db=db,
+                    readonly=self.readonly)
+
+    if ADD in self.ops:
+      router.add_api_route(self.path, add_item, methods=['POST'], name=f'add_{table}')
+    if UPDATE in self.ops:
+      router.add_api_route(f'{self.path}/{{item_id}}', update_item, methods=['PUT'],
+                           name=f'update_{table}')
+
+
+arrival_rows = serializer.RowMap(
+    md.Arrival,
+    product=(md.Arrival.product, {'id': 'product_id', 'name': md.Product.name}),
+    unit=(md.Arrival.unit, {'id': 'unit_id', 'name': md.Unit.name}),
+    supplier=(md.Arrival.supplier, {'id': 'supplier_id', 'name': md.Supplier.name}),
+)
+
+sale_rows = serializer.RowMap(
+    md.Sale,
+    master=(md.Sale.master, {'id': 'master_id', 'name': md.Master.name}),
+    user=(md.Sale.user, {'id': 'user_id', 'login': md.User.login}),
+)
+
+product_return_rows = serializer.RowMap(
+    md.ProductReturn,
+    product=(md.ProductReturn.product, {'id': 'product_id', 'name': md.Product.name}),
+    supplier=(md.ProductReturn.supplier, {'id': 'supplier_id', 'name': md.Supplier.name}),
+    user=(md.ProductReturn.user, {'id': 'user_id', 'login': md.User.login}),
+)
+
+disposal_rows = serializer.RowMap(
+    md.Disposal,
+    product=(md.Disposal.product, {'id': 'product_id', 'name': md.Product.name}),
+    user=(md.Disposal.user, {'id': 'user_id', 'login': md.User.login}),
+)
+
+inventory_rows = serializer.RowMap(
+    md.Inventory,
+    user=(md.Inventory.user, {'id': 'user_id', 'login': md.User.login}),
+)
+
+stock_rows = serializer.RowMap(
+    md.Stock,
+    product=(md.Stock.product, {'id': 'product_id', 'name': md.Product.name}),
+    supplier=(md.Stock.supplier, {'id': 'supplier_id', 'name': md.Supplier.name}),
+)
+
+
+def sale_stock_lines(sale_ids: List[int], db: Session) -> dict:
+  """Stock lines of the given sales, one query for the whole page.
+
+  count and price are the ones of the sale line; lines written before
+  they were recorded read as one unit at the stock price.
+  """
+  if not sale_ids:
+    return {}
+  link = md.sale_product_relationship
+  rows = db.query(link.c.sale_id, md.Stock.id, md.Stock.product_id,
+                  func.coalesce(link.c.count, 1), func.coalesce(link.c.price, md.Stock.price),
+                  md.Product.name) \
+      .join(md.Stock, md.Stock.id == link.c.stock_id) \
+      .outerjoin(md.Stock.product) \
+      .filter(link.c.sale_id.in_(sale_ids))
+  lines = {}
+  for sale_id, stock_id, product_id, count, price, product_name in rows:
+    lines.setdefault(sale_id, []).append({
+        'id': stock_id, 'product_id': product_id, 'count': count, 'price': price,
+        'product': {'id': product_id, 'name': product_name},
+    })
+  return lines
+
+
+def attach_sale_stock(db: Session, items: list):
+  lines = sale_stock_lines(list(map(itemgetter('id'), items)), db)
+  for x in items:
+    x['stock'] = lines.get(x['id'], [])
+
+
+def product_return_readonly(pr: md.ProductReturn) -> tuple:
+  # status only changes through /spend; once spent, the fields that
+  # decremented the stock are fixed as well
+  if pr.status == 0:
+    return ('status',)
+  return ('status', 'product_id', 'supplier_id', 'price', 'count')
+
+
+def disposal_readonly(disposal: md.Disposal) -> tuple:
+  # a disposal taken from stock already decremented it
+  if disposal.stock_id is None:
+    return ('stock_id',)
+  return ('stock_id', 'product_id', 'count')
+
+
+def reference(path: str, sql_model, pydantic: str) -> Resource:
+  return Resource(path, sql_model, pydantic,
+                  keys=[(sql_model.name, False), (sql_model.id, False)],
+                  search=True, cached=True, read_db=get_db)
+
+
+REGISTRY = [
+    reference('/api/product', md.Product, 'PydanticProduct'),
+    reference('/api/supplier', md.Supplier, 'PydanticSupplier'),
+    reference('/api/unit', md.Unit, 'PydanticUnit'),
+    reference('/api/master', md.Master, 'PydanticMaster'),
+    # added with its stock lines by main.add_arrival
+    Resource('/api/arrival', md.Arrival, 'PydanticArrival', arrival_rows, filters.ARRIVAL,
+             ops=(GET, LIST, UPDATE)),
+    # added and updated with stock and rollups in main
+    Resource('/api/sale', md.Sale, 'PydanticSale', sale_rows, filters.SALE,
+             ops=(GET, LIST), after_list=attach_sale_stock),
+    Resource('/api/product_return', md.ProductReturn, 'PydanticProductReturn',
+             product_return_rows, filters.PRODUCT_RETURN, defaults={'status': 0},
+             readonly=product_return_readonly),
+    # added against stock in main.add_disposal
+    Resource('/api/disposal', md.Disposal, 'PydanticDisposal', disposal_rows, filters.DISPOSAL,
+             ops=(GET, LIST, UPDATE), readonly=disposal_readonly),
+    # status only changes through /close, which applies the counted lines
+    Resource('/api/inventory', md.Inventory, 'PydanticInventory', inventory_rows,
+             filters.INVENTORY, defaults={'status': 0}, readonly=('status',)),
+    Resource('/api/stock', md.Stock, None, stock_rows, filters.STOCK, ops=(LIST,)),
+]
+
+
+def crud_router(resources: List[Resource]) -> APIRouter:
+  router = APIRouter()
+  for resource in resources:
+    resource.add_routes(router)
+  return router
+
+
+router = crud_router(REGISTRY)
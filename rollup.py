@@ -0,0 +1,133 @@
+"""Daily sales rollups per master, per user and per product.
+
+add_sale and update_sale keep md.SaleRollup up to date incrementally
+in their own transaction; `python -m rollup rebuild` recomputes it from
+the sales history.
+
+master/user rows: revenue = Sale.price, count = number of sales,
+stock_value = value of the stock lines sold. product rows: revenue and
+stock_value = line count * line price, count = quantity sold.
+"""
+import sys
+from datetime import date as dt_date
+from typing import List
+
+from sqlalchemy import delete, func, insert, literal, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import models as md
+
+DIMENSIONS = ('master', 'user', 'product')
+
+link = md.sale_product_relationship
+
+
+def sale_lines(db: Session, sale_id: int) -> List[tuple]:
+  """(product_id, count, price) of the stock lines of a sale."""
+  return db.query(md.Stock.product_id,
+                  func.coalesce(link.c.count, 1),
+                  func.coalesce(link.c.price, md.Stock.price)) \
+      .join(link, link.c.stock_id == md.Stock.id) \
+      .filter(link.c.sale_id == sale_id).all()
+
+
+def contributions(sale: md.Sale, lines: List[tuple]) -> List[dict]:
+  stock_value = sum(count * price for _, count, price in lines)
+  rows = [
+      {'date': sale.date, 'dimension': 'master', 'key_id': sale.master_id or 0,
+       'revenue': sale.price, 'count': 1, 'stock_value': stock_value},
+      {'date': sale.date, 'dimension': 'user', 'key_id': sale.user_id,
+       'revenue': sale.price, 'count': 1, 'stock_value': stock_value},
+  ]
+  for product_id, count, price in lines:
+    rows.append({'date': sale.date, 'dimension': 'product', 'key_id': product_id,
+                 'revenue': count * price, 'count': count, 'stock_value': count * price})
+  return rows
+
+
+def apply(db: Session, rows: List[dict], sign: int = 1):
+  """Add (sign=1) or take back (sign=-1) contributions with one upsert."""
+  merged = {}
+  for row in rows:
+    key = (row['date'], row['dimension'], row['key_id'])
+    if key not in merged:
+      merged[key] = dict(row, revenue=0, count=0, stock_value=0)
+    for k in ('revenue', 'count', 'stock_value'):
+      merged[key][k] += sign * row[k]
+  if not merged:
+    return
+  stmt = postgresql.insert(md.SaleRollup).values(list(merged.values()))
+  stmt = stmt.on_conflict_do_update(
+      constraint="uq_sale_rollup",
+      set_={
+          'revenue': md.SaleRollup.revenue + stmt.excluded.revenue,
+          'count': md.SaleRollup.count + stmt.excluded.count,
+          'stock_value': md.SaleRollup.stock_value + stmt.excluded.stock_value,
+      },
+  )
+  db.execute(stmt)
+
+
+def rebuild(db: Session):
+  """Recompute all rollups from sales with three INSERT ... SELECT."""
+  line_value = select(
+      link.c.sale_id,
+      func.sum(func.coalesce(link.c.count, 1) *
+               func.coalesce(link.c.price, md.Stock.price)).label('value'),
+  ).join(md.Stock, md.Stock.id == link.c.stock_id) \
+      .group_by(link.c.sale_id).subquery()
+  columns = ['date', 'dimension', 'key_id', 'revenue', 'count', 'stock_value']
+
+  db.execute(delete(md.SaleRollup))
+  for dimension, key in (('master', func.coalesce(md.Sale.master_id, 0)),
+                         ('user', md.Sale.user_id)):
+    db.execute(insert(md.SaleRollup).from_select(columns, select(
+        md.Sale.date, literal(dimension), key, func.sum(md.Sale.price),
+        func.count(), func.coalesce(func.sum(line_value.c.value), 0),
+    ).outerjoin(line_value, line_value.c.sale_id == md.Sale.id)
+        .group_by(md.Sale.date, key)))
+
+  count = func.coalesce(link.c.count, 1)
+  value = count * func.coalesce(link.c.price, md.Stock.price)
+  db.execute(insert(md.SaleRollup).from_select(columns, select(
+      md.Sale.date, literal('product'), md.Stock.product_id,
+      func.sum(value), func.sum(count), func.sum(value),
+  ).select_from(link)
+      .join(md.Sale, md.Sale.id == link.c.sale_id)
+      .join(md.Stock, md.Stock.id == link.c.stock_id)
+      .group_by(md.Sale.date, md.Stock.product_id)))
+  db.commit()
+
+
+def report(db: Session, dimension: str, from_date: dt_date = None,
+           to_date: dt_date = None, daily: bool = False) -> List[dict]:
+  model, name = {
+      'master': (md.Master, md.Master.name),
+      'user': (md.User, md.User.login),
+      'product': (md.Product, md.Product.name),
+  }[dimension]
+  group = [md.SaleRollup.key_id, name]
+  if daily:
+    group.insert(0, md.SaleRollup.date)
+  q = db.query(*group[:-1], name.label('name'),
+               func.sum(md.SaleRollup.revenue).label('revenue'),
+               func.sum(md.SaleRollup.count).label('count'),
+               func.sum(md.SaleRollup.stock_value).label('stock_value')) \
+      .outerjoin(model, model.id == md.SaleRollup.key_id) \
+      .filter(md.SaleRollup.dimension == dimension) \
+      .group_by(*group).order_by(*group)
+  if from_date is not None:
+    q = q.filter(md.SaleRollup.date >= from_date)
+  if to_date is not None:
+    q = q.filter(md.SaleRollup.date <= to_date)
+  return [dict(row._mapping) for row in q]
+
+
+if __name__ == '__main__':
+  if sys.argv[1:] != ['rebuild']:
+    sys.exit('usage: python -m rollup rebuild')
+  from db_conn import SessionLocal
+  session = SessionLocal()
+  rebuild(session)
+  session.close()
@@ -0,0 +1,44 @@
+from sqlalchemy import case, func, DDL, event, Column
+from sqlalchemy.orm import Query
+
+from db_conn import Base
+
+# the gin_trgm_ops indexes in models.py need pg_trgm, create it before the tables
+event.listen(
+    Base.metadata, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'),
+)
+
+
+def escape_like(term: str) -> str:
+  return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def contains(column: Column, term: str):
+  """Substring filter, served by the column's trigram index on postgres."""
+  return column.ilike(f'%{escape_like(term)}%', escape='\\')
+
+
+def rank(column: Column, term, prefix, id_column: Column) -> tuple:
+  """ORDER BY of a name search: prefix matches first, then by similarity.
+
+  `prefix` is the escaped LIKE pattern of `term`, e.g. 'ab%'. `id_column`
+  (the primary key) breaks ties between equal names, so offset pages
+  neither repeat nor skip rows.
+  """
+  return (
+      case((column.ilike(prefix, escape='\\'), 0), else_=1),
+      func.similarity(column, term).desc(),
+      column,
+      id_column,
+  )
+
+
+def name_search(q: Query, column: Column, term: str, id_column: Column) -> Query:
+  """Filter `q` on `term` and rank prefix matches first, then by similarity.
+
+  The ranking only holds for offset pages, the list endpoints reject a
+  search together with ?cursor=.
+  """
+  return q.filter(contains(column, term)).order_by(
+      *rank(column, term, f'{escape_like(term)}%', id_column))
@@ -0,0 +1,80 @@
+"""Row-projection serialization for the heavy list endpoints.
+
+Instead of loading ORM objects and letting jsonable_encoder walk them,
+a RowMap selects only the needed columns as tuples and turns each row
+into a dict with a field map built once per model.
+"""
+from operator import itemgetter
+
+from fastapi.responses import Response
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import Session
+
+try:
+  import orjson
+
+  def dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=str)
+except ImportError:
+  import json
+
+  def dumps(obj) -> bytes:
+    return json.dumps(obj, default=str, separators=(',', ':')).encode()
+
+
+class RowMap:
+  """Column projection of `sql_model` plus nested many-to-one objects.
+
+  nested maps an output name to (relationship, {key: column}), a column
+  may also be given as the name of one of the model's own fields:
+
+    RowMap(md.Arrival, product=(md.Arrival.product,
+                                {'id': 'product_id', 'name': md.Product.name}))
+  """
+
+  def __init__(self, sql_model, **nested):
+    self.fields = [a.key for a in inspect(sql_model).column_attrs]
+    self.columns = [getattr(sql_model, k) for k in self.fields]
+    self.joins = []
+    self._flat = itemgetter(*range(len(self.fields)))
+    self._nested = []
+    for name, (relationship, spec) in nested.items():
+      self.joins.append(relationship)
+      keys, indexes = [], []
+      for key, column in spec.items():
+        keys.append(key)
+        if isinstance(column, str):
+          indexes.append(self.fields.index(column))
+        else:
+          indexes.append(len(self.columns))
+          self.columns.append(column.label(f'{name}__{key}'))
+      self._nested.append((name, tuple(keys), itemgetter(*indexes)))
+
+  def query(self, db: Session):
+    q = db.query(*self.columns)
+    for relationship in self.joins:
+      q = q.outerjoin(relationship)
+    return q
+
+  def select(self):
+    stmt = select(*self.columns)
+    for relationship in self.joins:
+      stmt = stmt.outerjoin(relationship)
+    return stmt
+
+  def to_dict(self, row) -> dict:
+    d = dict(zip(self.fields, self._flat(row)))
+    for name, keys, getter in self._nested:
+      values = getter(row)
+      if len(keys) == 1:
+        values = (values,)
+      d[name] = dict(zip(keys, values)) if any(v is not None for v in values) else None
+    return d
+
+  def to_dicts(self, rows) -> list:
+    return [self.to_dict(row) for row in rows]
+
+
+def json_response(data, status_code: int = 200) -> Response:
+  return Response(content=dumps(data), status_code=status_code,
+                  media_type='application/json')
@@ -0,0 +1,180 @@
+"""Slow-query log with EXPLAIN capture.
+
+Statements slower than SLOW_QUERY_MS are written as JSON lines to a
+rotating log (SLOW_QUERY_LOG) with the route that issued them and, on
+postgres, the plan. Parameter values are replaced by their type names
+and the statement is only logged by its shape (literals replaced) unless
+SLOW_QUERY_LOG_PARAMETERS=1, they carry logins, names and other customer
+data.
+
+Plain SELECTs are re-run under EXPLAIN (ANALYZE, BUFFERS); anything
+else, WITH (which may hold a data-modifying CTE) and SELECT ... FOR
+UPDATE/SHARE included, only gets a plain EXPLAIN so it is never executed
+twice. The re-run is synchronous: the request that issued the slow
+query waits for it a second time. To bound that, the EXPLAIN runs under
+a statement_timeout of EXPLAIN_TIMEOUT_MS, only a SLOW_QUERY_EXPLAIN_SAMPLE
+fraction of the slow queries is explained, and a plan is captured at
+most once per statement shape every EXPLAIN_INTERVAL seconds. The
+EXPLAIN runs in a savepoint that is always rolled back.
+
+Summarize a log with: python -m slowlog summary [logfile] [--top N]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import time
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 500))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log')
+EXPLAIN_INTERVAL = float(os.environ.get('EXPLAIN_INTERVAL', 300))
+EXPLAIN_TIMEOUT_MS = int(os.environ.get('EXPLAIN_TIMEOUT_MS', 5000))
+EXPLAIN_SAMPLE = float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE', 1))
+LOG_PARAMETERS = os.environ.get('SLOW_QUERY_LOG_PARAMETERS', '0') == '1'
+MAX_PARAMETERS = 2000
+
+logger = logging.getLogger('slowlog')
+logger.propagate = False
+if SLOW_QUERY_MS > 0 and not logger.handlers:
+  _handler = RotatingFileHandler(SLOW_QUERY_LOG, maxBytes=20 * 1024 * 1024, backupCount=5)
+  _handler.setFormatter(logging.Formatter('%(message)s'))
+  logger.addHandler(_handler)
+  logger.setLevel(logging.INFO)
+
+_explained = {}
+_lock = Lock()
+
+
+def shape(statement: str) -> str:
+  """Statement with whitespace, literals and expanded IN lists normalized."""
+  s = ' '.join(statement.split())
+  s = re.sub(r"'(?:[^']|'')*'", '?', s)
+  s = re.sub(r'\b\d+(\.\d+)?\b', '?', s)
+  s = re.sub(r'%\(\w+\)s|\$\d+|\?|:\w+', '?', s)
+  s = re.sub(r'\((\s*\?\s*,)+\s*\?\s*\)', '(?...)', s)
+  return s
+
+
+def _analyzable(statement: str) -> bool:
+  """Plain SELECTs only, those are safe to execute a second time."""
+  s = ' '.join(statement.split()).upper()
+  if not s.startswith('SELECT'):
+    return False
+  return re.search(r'\bFOR (NO KEY )?(UPDATE|SHARE)\b|\bFOR KEY SHARE\b|\bINTO\b', s) is None
+
+
+def _explain(cursor, statement: str, parameters):
+  key = shape(statement)
+  now = time.monotonic()
+  with _lock:
+    if now - _explained.get(key, -EXPLAIN_INTERVAL) < EXPLAIN_INTERVAL:
+      return None
+    _explained[key] = now
+  options = 'ANALYZE, BUFFERS, FORMAT JSON' if _analyzable(statement) else 'FORMAT JSON'
+  # a separate DBAPI cursor on the same connection: same transaction and
+  # no engine events, so this does not recurse into the listeners. Rolling
+  # back to the savepoint undoes the EXPLAIN whatever it did, a failure
+  # included, and resets the SET LOCAL timeout.
+  raw = cursor.connection.cursor()
+  try:
+    raw.execute('SAVEPOINT slowlog_explain')
+    try:
+      raw.execute(f'SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS:d}')
+      raw.execute(f'EXPLAIN ({options}) {statement}', parameters)
+      plan = raw.fetchone()[0]
+    except Exception as e:
+      plan = {'error': str(e)}
+    raw.execute('ROLLBACK TO SAVEPOINT slowlog_explain')
+    raw.execute('RELEASE SAVEPOINT slowlog_explain')
+    return plan
+  except Exception as e:
+    return {'error': str(e)}
+  finally:
+    raw.close()
+
+
+def _redact(parameters):
+  if isinstance(parameters, dict):
+    return {k: _redact(v) for k, v in parameters.items()}
+  if isinstance(parameters, (list, tuple)):
+    return [_redact(v) for v in parameters]
+  return None if parameters is None else type(parameters).__name__
+
+
+def _parameters(parameters) -> str:
+  text = repr(parameters if LOG_PARAMETERS else _redact(parameters))
+  return text if len(text) <= MAX_PARAMETERS else text[:MAX_PARAMETERS] + '...'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if context is not None:
+    context._slowlog_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  if SLOW_QUERY_MS <= 0 or context is None:
+    return
+  elapsed = (time.perf_counter() - context._slowlog_started) * 1000
+  if elapsed < SLOW_QUERY_MS:
+    return
+  stats = metrics.current.get()
+  plan = None
+  # psycopg2 only: the async driver's cursors can not be reused here
+  if conn.dialect.name == 'postgresql' and conn.dialect.driver == 'psycopg2' \
+          and not executemany and not context.execution_options.get('stream_results') \
+          and random.random() < EXPLAIN_SAMPLE:
+    plan = _explain(cursor, statement, parameters)
+  logger.info(json.dumps({
+      'time': time.time(),
+      'duration_ms': round(elapsed, 2),
+      'route': stats.route_name() if stats is not None else None,
+      # inline literals are as sensitive as the parameters
+      'statement': statement if LOG_PARAMETERS else None,
+      'shape': shape(statement),
+      'parameters': _parameters(parameters),
+      'plan': plan,
+  }, default=str))
+
+
+def summary(path: str, top: int = 20):
+  shapes = {}
+  for name in [f'{path}.{i}' for i in range(5, 0, -1)] + [path]:
+    if not os.path.exists(name):
+      continue
+    with open(name) as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue
+        s = shapes.setdefault(entry['shape'], {'count': 0, 'total': 0.0, 'max': 0.0, 'routes': set()})
+        s['count'] += 1
+        s['total'] += entry['duration_ms']
+        s['max'] = max(s['max'], entry['duration_ms'])
+        if entry.get('route'):
+          s['routes'].add(entry['route'])
+  worst = sorted(shapes.items(), key=lambda x: x[1]['total'], reverse=True)[:top]
+  for statement, s in worst:
+    print(f'{s["count"]:>6} x  total {s["total"]:10.0f} ms  avg {s["total"] / s["count"]:8.0f} ms  '
+          f'max {s["max"]:8.0f} ms  {", ".join(sorted(s["routes"]))}')
+    print(f'         {statement[:300]}')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(prog='python -m slowlog')
+  parser.add_argument('command', choices=['summary'])
+  parser.add_argument('logfile', nargs='?', default=SLOW_QUERY_LOG)
+  parser.add_argument('--top', type=int, default=20)
+  args = parser.parse_args()
+  summary(args.logfile, args.top)
@@ -0,0 +1,78 @@
+"""Atomic stock decrements for sales, supplier returns and disposals.
+
+Every decrement is a single guarded UPDATE ... WHERE count >= :n
+RETURNING, so concurrent documents can not oversell a stock row and
+there is no read-modify-write window. The functions only flush; the
+caller commits them together with its document.
+"""
+from typing import Dict, List
+
+from fastapi import HTTPException, status
+from sqlalchemy import Float, Integer, column, update, values
+from sqlalchemy.orm import Session
+
+import models as md
+
+
+def not_found():
+  return HTTPException(
+      status_code=status.HTTP_404_NOT_FOUND,
+      detail="Stock item not found",
+  )
+
+
+def not_enough():
+  return HTTPException(
+      status_code=status.HTTP_400_BAD_REQUEST,
+      detail="product count is not valid",
+  )
+
+
+def merge_lines(lines) -> Dict[int, float]:
+  """stock id -> total count for (stock_id, count) pairs."""
+  merged = {}
+  for stock_id, count in lines:
+    merged[stock_id] = merged.get(stock_id, 0) + count
+  return merged
+
+
+def spend(db: Session, lines: Dict[int, float]) -> List[tuple]:
+  """Take `count` off every stock id in `lines` in one statement.
+
+  Returns (id, product_id, supplier_id, price) of the updated rows. If
+  any line can not be served nothing is changed and 404/400 is raised.
+  """
+  if not lines:
+    return []
+  if any(n <= 0 for n in lines.values()):
+    raise not_enough()
+  batch = values(column('id', Integer), column('n', Float), name='lines') \
+      .data(sorted(lines.items()))
+  stmt = update(md.Stock) \
+      .where(md.Stock.id == batch.c.id, md.Stock.count >= batch.c.n) \
+      .values(count=md.Stock.count - batch.c.n) \
+      .returning(md.Stock.id, md.Stock.product_id, md.Stock.supplier_id, md.Stock.price) \
+      .execution_options(synchronize_session=False)
+  rows = db.execute(stmt).all()
+  if len(rows) != len(lines):
+    db.rollback()
+    found = {x for (x,) in db.query(md.Stock.id).filter(md.Stock.id.in_(list(lines)))}
+    raise not_found() if len(found) != len(lines) else not_enough()
+  return rows
+
+
+def spend_by_key(db: Session, product_id: int, supplier_id: int, price: float, count: float) -> int:
+  """Decrement the stock row of a (product, supplier, price) lot, returns its id."""
+  key = (md.Stock.product_id == product_id,
+         md.Stock.supplier_id == supplier_id,
+         md.Stock.price == price)
+  stmt = update(md.Stock) \
+      .where(*key, md.Stock.count >= count) \
+      .values(count=md.Stock.count - count) \
+      .returning(md.Stock.id) \
+      .execution_options(synchronize_session=False)
+  stock_id = db.execute(stmt).scalar()
+  if stock_id is None:
+    db.rollback()
+    raise not_found() if db.query(md.Stock.id).filter(*key).first() is None else not_enough()
+  return stock_id
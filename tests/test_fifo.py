@@ -0,0 +1,79 @@
+from datetime import date
+
+from fifo import ARRIVAL, DISPOSAL, PRODUCT_RETURN, SALE, Ledger, replay
+
+D1, D2, D3 = date(2023, 1, 1), date(2023, 1, 2), date(2023, 1, 3)
+
+
+def test_sale_takes_oldest_layers_first():
+  ledger, lines = replay([
+      (D1, ARRIVAL, 1, 7, 10, 2.0),
+      (D2, ARRIVAL, 2, 7, 5, 3.0),
+      (D3, SALE, 1, 7, 12, 10.0),
+  ])
+  assert lines[1, 7] == {'sale_id': 1, 'product_id': 7, 'date': D3,
+                         'revenue': 120.0, 'cogs': 10 * 2.0 + 2 * 3.0, 'uncosted': 0.0}
+  assert ledger.rows(7) == [{'product_id': 7, 'seq': 0, 'count': 3, 'cost': 3.0}]
+
+
+def test_partial_layer_stays_open():
+  ledger, lines = replay([
+      (D1, ARRIVAL, 1, 7, 10, 2.0),
+      (D2, SALE, 1, 7, 4, 5.0),
+      (D3, SALE, 2, 7, 4, 5.0),
+  ])
+  assert lines[1, 7]['cogs'] == 8.0
+  assert lines[2, 7]['cogs'] == 8.0
+  assert ledger.rows(7) == [{'product_id': 7, 'seq': 0, 'count': 2, 'cost': 2.0}]
+
+
+def test_returns_and_disposals_consume_layers():
+  ledger, lines = replay([
+      (D1, ARRIVAL, 1, 7, 5, 2.0),
+      (D1, ARRIVAL, 2, 7, 5, 4.0),
+      (D2, PRODUCT_RETURN, 1, 7, 3, 2.0),
+      (D2, DISPOSAL, 1, 7, 3, 0.0),
+      (D3, SALE, 1, 7, 2, 10.0),
+  ])
+  assert lines == {(1, 7): {'sale_id': 1, 'product_id': 7, 'date': D3,
+                            'revenue': 20.0, 'cogs': 8.0, 'uncosted': 0.0}}
+  assert ledger.rows(7) == [{'product_id': 7, 'seq': 0, 'count': 2, 'cost': 4.0}]
+
+
+def test_sale_beyond_layers_uses_last_cost():
+  ledger, lines = replay([
+      (D1, ARRIVAL, 1, 7, 2, 3.0),
+      (D2, SALE, 1, 7, 5, 10.0),
+  ])
+  assert lines[1, 7]['cogs'] == 5 * 3.0
+  assert lines[1, 7]['uncosted'] == 3
+  # the emptied product keeps its last cost for later sales
+  assert ledger.rows(7) == [{'product_id': 7, 'seq': 0, 'count': 0, 'cost': 3.0}]
+
+
+def test_sale_without_any_arrival_is_uncosted():
+  ledger, lines = replay([(D1, SALE, 1, 7, 2, 10.0)])
+  assert lines[1, 7]['cogs'] == 0.0
+  assert lines[1, 7]['uncosted'] == 2
+  assert ledger.rows(7) == []
+
+
+def test_lines_of_one_product_on_a_sale_are_merged():
+  _, lines = replay([
+      (D1, ARRIVAL, 1, 7, 10, 2.0),
+      (D1, ARRIVAL, 2, 8, 10, 1.0),
+      (D2, SALE, 1, 7, 1, 10.0),
+      (D2, SALE, 1, 7, 2, 12.0),
+      (D2, SALE, 1, 8, 1, 5.0),
+  ])
+  assert lines[1, 7]['revenue'] == 34.0
+  assert lines[1, 7]['cogs'] == 6.0
+  assert lines[1, 8]['cogs'] == 1.0
+
+
+def test_products_are_independent():
+  ledger = Ledger()
+  ledger.add(1, 5, 2.0)
+  ledger.add(2, 5, 7.0)
+  assert ledger.take(2, 5) == (35.0, 0.0)
+  assert ledger.take(1, 1) == (2.0, 0.0)